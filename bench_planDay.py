@@ -0,0 +1,300 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time as clock
+from datetime import datetime, timezone
+
+# Замер стоимости обработчиков planDay без сети.
+# Обработчики вызываются напрямую с синтетическими Update/CallbackQuery,
+# а вместо Telegram используется бот-заглушка, который только записывает ответы.
+#
+# Пример:
+#     python bench_planDay.py --users 1000 --tasks 50 --iterations 2000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков planDay")
+    parser.add_argument('--users', type=int, default=1000, help="число пользователей в базе")
+    parser.add_argument('--tasks', type=int, default=30, help="задач на пользователя")
+    parser.add_argument('--days', type=int, default=7, help="на сколько дней вокруг сегодня распределены задачи")
+    parser.add_argument('--iterations', type=int, default=1000, help="вызовов каждого обработчика")
+    parser.add_argument('--concurrency', type=int, default=1, help="одновременных вызовов")
+    parser.add_argument('--db', default=None, help="путь к базе (по умолчанию временный файл)")
+    parser.add_argument('--reset', action='store_true', help="удалить задачи и подписки, уже лежащие в базе --db")
+    parser.add_argument('--storage', choices=('sqlite', 'memory', 'sharded'), default='sqlite', help="хранилище")
+    parser.add_argument('--shards', type=int, default=4, help="число шардов для --storage sharded")
+    parser.add_argument('--no-cache', action='store_true', help="отключить кэш списков дня")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help="дописать отчет в файл")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Настройки planDay читаются из окружения при импорте
+if args.db is None:
+    args.db = os.path.join(tempfile.mkdtemp(prefix='planday-bench-'), 'planner.db')
+os.environ['PLANNER_DB'] = args.db
+os.environ['PLANNER_STORAGE'] = args.storage
+os.environ['PLANNER_SHARDS'] = str(args.shards)
+# Отрисовка навигации без паузы: замеряется сама отрисовка
+os.environ.setdefault('PLANNER_NAVIGATION_DELAY_MS', '0')
+if args.no_cache:
+    os.environ['PLANNER_DAY_CACHE_SIZE'] = '0'
+
+import logging  # noqa: E402
+from telegram import Bot, CallbackQuery, Chat, Message, Update, User  # noqa: E402
+
+import planDay  # noqa: E402
+
+logging.getLogger('planDay').setLevel(logging.WARNING)
+
+
+# Бот-заглушка: вместо запросов к API запоминает ответы
+class RecordingBot(Bot):
+    def __init__(self):
+        super().__init__('0:benchmark')
+        # Объекты PTB заморожены после создания, список заводим до заморозки
+        with self._unfrozen():
+            self.replies = []
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        self.replies.append(('send_message', chat_id, text))
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        self.replies.append(('edit_message_text', kwargs.get('chat_id'), text))
+
+    async def answer_callback_query(self, *args, **kwargs):
+        return True
+
+    async def send_document(self, chat_id, document, *args, **kwargs):
+        self.replies.append(('send_document', chat_id, None))
+
+
+class BenchContext:
+    def __init__(self, bot, args=None, user_data=None):
+        self.bot = bot
+        self.args = args or []
+        self.user_data = user_data if user_data is not None else {}
+        self.job_queue = None
+        self.application = None
+
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._next_id = 0
+
+    def _id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def _message(self, user_id: int, text: str) -> Message:
+        user = User(user_id, 'bench', False)
+        message = Message(self._id(), datetime.now(), Chat(user_id, 'private'), from_user=user, text=text)
+        message.set_bot(self.bot)
+        return message
+
+    def message(self, user_id: int, text: str) -> Update:
+        update = Update(self._id(), message=self._message(user_id, text))
+        update.set_bot(self.bot)
+        return update
+
+    def callback(self, user_id: int, data: str) -> Update:
+        user = User(user_id, 'bench', False)
+        query = CallbackQuery(str(self._id()), user, 'bench', message=self._message(user_id, 'list'), data=data)
+        query.set_bot(self.bot)
+        update = Update(self._id(), callback_query=query)
+        update.set_bot(self.bot)
+        return update
+
+
+def seed_sqlite(path: str, user_ids: list, tasks: int, days: list) -> None:
+    conn = sqlite3.connect(path)
+    # Базу с данными (например, рабочую, переданную через --db) очищаем только с --reset
+    if not args.reset and conn.execute(
+        "SELECT EXISTS (SELECT 1 FROM tasks) OR EXISTS (SELECT 1 FROM subscriptions)"
+    ).fetchone()[0]:
+        conn.close()
+        sys.exit(f"{path} already has tasks or subscriptions; pass --reset to delete them before seeding")
+    with conn:
+        conn.execute("DELETE FROM tasks")
+        conn.execute("DELETE FROM subscriptions")
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'tasks'")
+        conn.executemany(
+            "INSERT INTO tasks (id, user_id, day, task, completed) VALUES (?, ?, ?, ?, ?)",
+            (
+                (user_id * tasks + number + 1, user_id, days[number % len(days)],
+                 f"Задача {number} пользователя {user_id}", int(number % 3 == 0))
+                for user_id in user_ids
+                for number in range(tasks)
+            )
+        )
+        conn.executemany("INSERT INTO subscriptions (user_id) VALUES (?)", ((user_id,) for user_id in user_ids))
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+# Заполнение хранилища синтетическими пользователями и задачами.
+# id задач идут подряд: у пользователя u задачи с u * tasks + 1 по (u + 1) * tasks.
+async def seed(users: int, tasks: int, days: list) -> None:
+    started = clock.perf_counter()
+    storage = planDay.storage
+    if isinstance(storage, planDay.MemoryStorage):
+        # Пустое хранилище в памяти выдает id по порядку вставки
+        for user_id in range(users):
+            await storage.import_tasks(user_id, (
+                (days[number % len(days)], f"Задача {number} пользователя {user_id}", int(number % 3 == 0))
+                for number in range(tasks)
+            ))
+            await storage.add_subscription(user_id)
+    elif isinstance(storage, planDay.ShardedSQLiteStorage):
+        groups = {}
+        for user_id in range(users):
+            groups.setdefault(storage.shard(user_id).path, []).append(user_id)
+        for shard in storage.shards:
+            seed_sqlite(shard.path, groups.get(shard.path, []), tasks, days)
+    else:
+        seed_sqlite(storage.path, list(range(users)), tasks, days)
+    print(f"Seeded {users * tasks} tasks for {users} users in {clock.perf_counter() - started:.2f}s")
+
+
+def percentile(samples: list, fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def measure(name: str, make_call, iterations: int, concurrency: int) -> dict:
+    samples = []
+
+    async def timed(call):
+        started = clock.perf_counter()
+        await call
+        samples.append(clock.perf_counter() - started)
+
+    started = clock.perf_counter()
+    for offset in range(0, iterations, concurrency):
+        batch = range(offset, min(offset + concurrency, iterations))
+        await asyncio.gather(*(timed(make_call(i)) for i in batch))
+    elapsed = clock.perf_counter() - started
+
+    samples.sort()
+    return {
+        'name': name,
+        'count': len(samples),
+        'throughput': len(samples) / elapsed if elapsed else 0.0,
+        'p50': percentile(samples, 0.50) * 1000,
+        'p95': percentile(samples, 0.95) * 1000,
+        'p99': percentile(samples, 0.99) * 1000,
+    }
+
+
+async def run() -> list:
+    rng = random.Random(args.seed)
+    # Дни хранятся номерами (date.toordinal()), как в базе и в callback_data
+    today = planDay.today()
+    days = [today + offset - args.days // 2 for offset in range(args.days)]
+    await seed(args.users, args.tasks, days)
+
+    bot = RecordingBot()
+    updates = UpdateFactory(bot)
+
+    def user() -> int:
+        return rng.randrange(args.users)
+
+    def own_task(user_id: int) -> int:
+        return user_id * args.tasks + rng.randrange(args.tasks) + 1
+
+    # Удаляются разные задачи, чтобы каждый вызов действительно что-то удалял
+    deletable = rng.sample(range(args.users * args.tasks), min(args.iterations, args.users * args.tasks))
+
+    def delete_call(i: int):
+        number = deletable[i % len(deletable)]
+        user_id = number // args.tasks
+        return planDay.button_handler(updates.callback(user_id, f"delete_{number + 1}"), BenchContext(bot))
+
+    async def navigate(update):
+        # Навигация отрисовывается в фоне, дожидаемся отправки
+        await planDay.button_handler(update, BenchContext(bot))
+        await planDay.navigation.join()
+
+    def callback(prefix: str):
+        def make_call(i: int):
+            user_id = user()
+            if prefix in ('prev_', 'next_', 'back_'):
+                return navigate(updates.callback(user_id, prefix + str(rng.choice(days))))
+            data = prefix + str(own_task(user_id))
+            return planDay.button_handler(updates.callback(user_id, data), BenchContext(bot))
+        return make_call
+
+    def list_call(i: int):
+        return planDay.list_tasks(updates.message(user(), '/list'), BenchContext(bot, args=[planDay.format_day(rng.choice(days))]))
+
+    def get_task_call(i: int):
+        context = BenchContext(bot, user_data={'day': rng.choice(days)})
+        return planDay.get_task(updates.message(user(), f"Новая задача {i}"), context)
+
+    cases = [
+        ('list_tasks', list_call),
+        ('button:view', callback('view_')),
+        ('button:prev', callback('prev_')),
+        ('button:next', callback('next_')),
+        ('button:back', callback('back_')),
+        ('button:done', callback('done_')),
+        ('get_task', get_task_call),
+        ('button:delete', delete_call),
+    ]
+
+    results = []
+    for name, make_call in cases:
+        results.append(await measure(name, make_call, args.iterations, args.concurrency))
+
+    # Рассылка напоминаний: один вызов на всех подписчиков,
+    # пропускная способность считается в отправленных сообщениях
+    due = {planDay.DEFAULT_TIMEZONE: list(range(args.users))}
+    replies_before = len(bot.replies)
+    result = await measure(
+        'send_daily_reminder',
+        lambda i: planDay.dispatch_reminders(bot, due, datetime.now(timezone.utc)),
+        1, 1
+    )
+    result['count'] = len(bot.replies) - replies_before
+    result['throughput'] = result['count'] / (result['p50'] / 1000)
+    results.append(result)
+
+    await planDay.storage.close()
+    return results
+
+
+def report(results: list) -> str:
+    lines = [
+        f"users={args.users} tasks/user={args.tasks} days={args.days} "
+        f"iterations={args.iterations} concurrency={args.concurrency} cache={'off' if args.no_cache else 'on'} "
+        f"storage={args.storage}",
+        f"{'handler':<22}{'calls':>8}{'ops/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for result in results:
+        lines.append(
+            f"{result['name']:<22}{result['count']:>8}{result['throughput']:>12.1f}"
+            f"{result['p50']:>10.3f}{result['p95']:>10.3f}{result['p99']:>10.3f}"
+        )
+    lines.append(f"day cache: {planDay.day_cache.stats()}")
+    lines.append(f"write queue: {planDay.storage.stats()}")
+    lines.append(f"navigation: {planDay.navigation.stats()}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    results = asyncio.run(run())
+    text = report(results)
+    print(text)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as output:
+            output.write(text + "\n\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+
+# Проверка планов горячих запросов planDay (HOT_QUERIES, включая поиск).
+# По умолчанию схема создается миграциями во временной базе; с --db проверяется
+# существующая база как есть, только на чтение. Код выхода 1, если хотя бы один
+# запрос сканирует таблицу, сортирует во временном B-дереве или материализует
+# подзапрос, - скрипт можно запускать в CI.
+#
+# Пример:
+#     python check_plans_planDay.py
+#     python check_plans_planDay.py --db planner.db
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Проверка планов запросов planDay")
+    parser.add_argument('--db', default=None, help="проверить существующую базу (по умолчанию новая временная)")
+    parser.add_argument('--verbose', action='store_true', help="печатать планы всех запросов")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Настройки planDay читаются из окружения при импорте: хранилище создает схему во временной базе
+os.environ['PLANNER_DB'] = os.path.join(tempfile.mkdtemp(prefix='planday-plans-'), 'planner.db')
+os.environ['PLANNER_STORAGE'] = 'sqlite'
+
+import logging  # noqa: E402
+
+# Сообщения о миграциях временной базы не нужны, предупреждения о планах остаются
+logging.getLogger('planDay').setLevel(logging.WARNING)
+
+import planDay  # noqa: E402
+
+
+def main() -> int:
+    if args.db is None:
+        conn = sqlite3.connect(os.environ['PLANNER_DB'])
+    else:
+        conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    try:
+        problems = planDay.check_query_plans(conn)
+        for name, (sql, params) in planDay.HOT_QUERIES.items():
+            if name not in problems and not args.verbose:
+                continue
+            status = "FAIL" if name in problems else "ok"
+            print(f"{status:<5} {name}")
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+                print(f"        {row[3]}")
+    finally:
+        conn.close()
+
+    print(f"{len(planDay.HOT_QUERIES) - len(problems)}/{len(planDay.HOT_QUERIES)} queries served by an index")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
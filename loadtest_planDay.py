@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time as clock
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl
+
+# Сквозной нагрузочный тест planDay.
+# Бот запускается отдельным процессом через main() с настоящим стеком
+# ApplicationBuilder (getUpdates, HTTP-клиент, очередь исходящих запросов),
+# но вместо api.telegram.org ходит в локальную заглушку Bot API.
+# Заглушка раздает обновления симулированных пользователей через getUpdates
+# и принимает ответы бота; задержка - от появления обновления в очереди
+# до ответа бота в этот чат.
+#
+# Пример:
+#     python loadtest_planDay.py --users 2000 --actions 20
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест planDay с заглушкой Bot API")
+    parser.add_argument('--users', type=int, default=1000, help="число симулированных пользователей")
+    parser.add_argument('--actions', type=int, default=20, help="действий на пользователя после /start и /add")
+    parser.add_argument('--think', type=float, default=0.0, help="пауза пользователя между действиями, с")
+    parser.add_argument('--timeout', type=float, default=30.0, help="сколько ждать ответа бота, с")
+    parser.add_argument('--port', type=int, default=0, help="порт заглушки (по умолчанию свободный)")
+    parser.add_argument('--db', default=None, help="путь к базе (по умолчанию временный файл)")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="оставить лимиты исходящих сообщений Telegram (иначе сняты)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help="дописать отчет в файл")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+TOKEN = '1:loadtest'
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'planDay', 'username': 'planday_loadtest_bot'}
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'planDay.py')
+
+
+def percentile(samples: list, fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+# Симулированный пользователь: ответы бота в его чат приходят в inbox
+class SimulatedUser:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.inbox = asyncio.Queue()
+        self.next_message_id = itertools.count(1)
+        # Последнее сообщение бота с клавиатурой: (message_id, текст, callback_data кнопок)
+        self.keyboard = None
+
+    def profile(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f"user{self.user_id}"}
+
+    def chat(self) -> dict:
+        return {'id': self.user_id, 'type': 'private', 'first_name': f"user{self.user_id}"}
+
+
+# Заглушка Bot API: HTTP/1.1 с keep-alive поверх asyncio, как /metrics в planDay
+class FakeBotAPI:
+    def __init__(self):
+        self.users = {}
+        self.calls = {}
+        self.stray = 0
+        self.updates_delivered = 0
+        self.polling = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._pending = []
+        self._arrived = asyncio.Event()
+        self._bot_message_ids = itertools.count(1000000)
+        self._server = None
+        self._connections = set()
+
+    async def start(self, port: int) -> int:
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+        # Незавершенные длинные опросы getUpdates возвращаются сразу
+        self._arrived.set()
+        if self._connections:
+            await asyncio.wait(self._connections, timeout=5)
+
+    # Обновления от пользователей
+    def push(self, payload: dict) -> None:
+        payload['update_id'] = next(self._update_ids)
+        self._pending.append(payload)
+        self._arrived.set()
+
+    def message(self, user: SimulatedUser, text: str) -> None:
+        message = {
+            'message_id': next(user.next_message_id),
+            'date': int(clock.time()),
+            'chat': user.chat(),
+            'from': user.profile(),
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split(maxsplit=1)[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        self.push({'message': message})
+
+    def callback(self, user: SimulatedUser, message_id: int, text: str, data: str) -> None:
+        self.push({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': user.profile(),
+            'chat_instance': str(user.user_id),
+            'data': data,
+            'message': {'message_id': message_id, 'date': int(clock.time()), 'chat': user.chat(),
+                        'from': BOT_USER, 'text': text},
+        }})
+
+    async def _get_updates(self, params: dict) -> list:
+        self.polling.set()
+        offset = int(params.get('offset', 0) or 0)
+        # Все обновления с id меньше offset подтверждены ботом
+        self._pending = [update for update in self._pending if update['update_id'] >= offset]
+        if not self._pending:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), float(params.get('timeout', 0) or 0))
+            except asyncio.TimeoutError:
+                pass
+        updates = self._pending[:int(params.get('limit', 100) or 100)]
+        self.updates_delivered += len(updates)
+        # Выданные обновления убираются сразу, повторный getUpdates с тем же offset их не получит
+        self._pending = self._pending[len(updates):]
+        return updates
+
+    def _deliver(self, params: dict, message_id: int = None) -> dict:
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': message_id or next(self._bot_message_ids),
+            'date': int(clock.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        user = self.users.get(chat_id)
+        if user is None:
+            self.stray += 1
+        else:
+            user.inbox.put_nowait((clock.perf_counter(), message))
+        return message
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self._deliver(params)
+        if method == 'editMessageText':
+            return self._deliver(params, int(params['message_id']))
+        # answerCallbackQuery, deleteWebhook и прочее
+        return True
+
+    @staticmethod
+    def _parse(headers: dict, body: bytes) -> dict:
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return dict(parse_qsl(body.decode()))
+        # multipart (файлы) в сценарии не встречается
+        return {}
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method = request_line.split()[1].decode().rsplit('/', 1)[-1]
+                result = await self.call(method, self._parse(headers, body))
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    f"HTTP/1.1 200 OK\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+
+class LoadTest:
+    # Кнопки, которые нажимают пользователи: навигация, просмотр и отметка
+    BUTTONS = ('view_', 'done_', 'back_', 'next_', 'prev_', 'page_', 'day_')
+
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+        self.rng = random.Random(args.seed)
+        # действие -> задержки в секундах
+        self.samples = {}
+        self.timeouts = 0
+        self.first_update = None
+        self.last_response = None
+
+    async def _exchange(self, user: SimulatedUser, action: str, send) -> dict:
+        # Отправляет обновление и ждет одного ответа бота в чат пользователя
+        while not user.inbox.empty():
+            user.inbox.get_nowait()
+        started = clock.perf_counter()
+        if self.first_update is None:
+            self.first_update = started
+        send()
+        try:
+            finished, message = await asyncio.wait_for(user.inbox.get(), args.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None
+        self.samples.setdefault(action, []).append(finished - started)
+        self.last_response = finished
+        if 'reply_markup' in message:
+            buttons = [
+                button['callback_data']
+                for row in message['reply_markup'].get('inline_keyboard', [])
+                for button in row
+                if button.get('callback_data', '').startswith(self.BUTTONS)
+            ]
+            user.keyboard = (message['message_id'], message['text'], buttons) if buttons else None
+        elif action == 'button':
+            # Сообщение без кнопок (задача выполнена, задач нет) - дальше снова /list
+            user.keyboard = None
+        return message
+
+    def _day(self, offset: int) -> str:
+        return (datetime.now() + timedelta(days=offset)).strftime('%Y-%m-%d')
+
+    async def _add(self, user: SimulatedUser) -> None:
+        api = self.api
+        if await self._exchange(user, 'add', lambda: api.message(user, '/add')) is None:
+            return
+        day = self._day(self.rng.randrange(-1, 3))
+        if await self._exchange(user, 'add', lambda: api.message(user, day)) is None:
+            return
+        await self._exchange(user, 'add', lambda: api.message(user, f"Задача {self.rng.randrange(10 ** 6)}"))
+
+    async def _press(self, user: SimulatedUser) -> None:
+        message_id, text, buttons = user.keyboard
+        data = self.rng.choice(buttons)
+        await self._exchange(user, 'button', lambda: self.api.callback(user, message_id, text, data))
+
+    async def run_user(self, user: SimulatedUser) -> None:
+        api = self.api
+        await self._exchange(user, 'start', lambda: api.message(user, '/start'))
+        # Несколько задач на ближайшие дни одним сообщением
+        lines = "\n".join(f"{self._day(offset % 3)} Задача {offset}" for offset in range(6))
+        await self._exchange(user, 'add_bulk', lambda: api.message(user, f"/add\n{lines}"))
+
+        for _ in range(args.actions):
+            if args.think:
+                await asyncio.sleep(self.rng.uniform(0, 2 * args.think))
+            choice = self.rng.random()
+            if choice < 0.2:
+                await self._add(user)
+            elif choice < 0.4 or user.keyboard is None:
+                await self._exchange(user, 'list', lambda: api.message(user, '/list'))
+            else:
+                await self._press(user)
+
+    def report(self, elapsed: float) -> str:
+        total = sum(len(samples) for samples in self.samples.values())
+        span = (self.last_response - self.first_update) if self.last_response else elapsed
+        lines = [
+            f"users={args.users} actions/user={args.actions} think={args.think}s "
+            f"limits={'telegram' if args.telegram_limits else 'off'}",
+            f"{'action':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for action, samples in sorted(self.samples.items()):
+            samples.sort()
+            lines.append(
+                f"{action:<14}{len(samples):>8}{percentile(samples, 0.50) * 1000:>10.1f}"
+                f"{percentile(samples, 0.95) * 1000:>10.1f}{percentile(samples, 0.99) * 1000:>10.1f}"
+                f"{samples[-1] * 1000:>10.1f}"
+            )
+        lines.append(
+            f"updates answered: {total} in {span:.2f}s = {total / span if span else 0.0:.1f} updates/s, "
+            f"timeouts: {self.timeouts}, delivered by getUpdates: {self.api.updates_delivered}"
+        )
+        lines.append(f"api calls: {dict(sorted(self.api.calls.items()))}, responses to unknown chats: {self.api.stray}")
+        return "\n".join(lines)
+
+
+def bot_environment(port: int) -> dict:
+    env = dict(os.environ)
+    if args.db is None:
+        args.db = os.path.join(tempfile.mkdtemp(prefix='planday-load-'), 'planner.db')
+    env['PLANNER_DB'] = args.db
+    env['PLANNER_TOKEN'] = TOKEN
+    env['PLANNER_API_BASE_URL'] = f"http://127.0.0.1:{port}"
+    env['PLANNER_MODE'] = 'polling'
+    if not args.telegram_limits:
+        # Замеряется сам бот, а не лимиты Telegram
+        env.setdefault('PLANNER_OUTBOUND_RATE', '1000000')
+        env.setdefault('PLANNER_OUTBOUND_CHAT_RATE', '1000000')
+        env.setdefault('PLANNER_OUTBOUND_CHAT_BURST', '1000')
+    return env
+
+
+async def run() -> str:
+    api = FakeBotAPI()
+    port = await api.start(args.port)
+    env = bot_environment(port)
+    log_path = os.path.splitext(args.db)[0] + '.log'
+    with open(log_path, 'w') as log:
+        bot = await asyncio.create_subprocess_exec(sys.executable, SCRIPT, env=env, stdout=log, stderr=log)
+    print(f"Bot started (pid {bot.pid}), Bot API stub on port {port}, log: {log_path}")
+
+    try:
+        await asyncio.wait_for(api.polling.wait(), 60)
+        test = LoadTest(api)
+        users = [SimulatedUser(user_id) for user_id in range(100000, 100000 + args.users)]
+        api.users = {user.user_id: user for user in users}
+        started = clock.perf_counter()
+        await asyncio.gather(*(test.run_user(user) for user in users))
+        return test.report(clock.perf_counter() - started)
+    finally:
+        if bot.returncode is None:
+            bot.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(bot.wait(), 30)
+            except asyncio.TimeoutError:
+                bot.kill()
+        await api.stop()
+
+
+def main() -> None:
+    text = asyncio.run(run())
+    print(text)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as output:
+            output.write(text + "\n\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,40 @@
+import asyncio
+import bisect
+import csv
+import functools
+import heapq
+import itertools
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time as clock
 import sqlite3
+import warnings
 import logging
-from datetime import datetime, time, timedelta
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.warnings import PTBUserWarning
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
     filters,
     ContextTypes
 )
@@ -22,13 +49,283 @@ logger = logging.getLogger(__name__)
 # Константы состояний
 DATE, TASK, EDIT, DELETE, NEW_TEXT, VIEW_DATE = range(6)
 
+# Путь к базе данных
+DB_PATH = os.getenv('PLANNER_DB', 'planner.db')
+
+# Хранилище: sqlite (один файл), memory (в памяти, для тестов и бенчмарков)
+# или sharded (SQLite, разбитый по хэшу user_id на PLANNER_SHARDS файлов).
+# PLANNER_SHARD_PATHS - пути шардов через запятую, например на разных дисках.
+STORAGE_BACKEND = os.getenv('PLANNER_STORAGE', 'sqlite')
+SHARDS = int(os.getenv('PLANNER_SHARDS', '4'))
+SHARD_PATHS = [path for path in os.getenv('PLANNER_SHARD_PATHS', '').split(',') if path]
+
+# Состояние диалогов и user_data переживает перезапуск: отдельный файл SQLite,
+# изменения сбрасываются каждые PLANNER_STATE_FLUSH_INTERVAL секунд.
+# Пустой PLANNER_STATE_DB отключает сохранение.
+STATE_DB_PATH = os.getenv('PLANNER_STATE_DB', os.path.splitext(DB_PATH)[0] + '.state.db')
+STATE_FLUSH_INTERVAL = float(os.getenv('PLANNER_STATE_FLUSH_INTERVAL', '10'))
+
+# Доступ к Bot API: токен бота и адрес сервера. PLANNER_API_BASE_URL задает
+# собственный сервер Bot API или заглушку нагрузочного теста (loadtest_planDay.py)
+BOT_TOKEN = os.getenv('PLANNER_TOKEN', '')
+API_BASE_URL = os.getenv('PLANNER_API_BASE_URL', '')
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('PLANNER_MODE', 'polling')
+WEBHOOK_URL = os.getenv('PLANNER_WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('PLANNER_WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('PLANNER_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('PLANNER_WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('PLANNER_WEBHOOK_SECRET', '')
+
+# Число одновременно обрабатываемых обновлений
+CONCURRENT_UPDATES = int(os.getenv('PLANNER_CONCURRENT_UPDATES', '64'))
+
+# Пауза перед отрисовкой по кнопке навигации: нажатия, пришедшие за это
+# время на то же сообщение, заменяют ожидающую отрисовку
+NAVIGATION_DELAY = float(os.getenv('PLANNER_NAVIGATION_DELAY_MS', '100')) / 1000
+
+# Кэш отрисованных списков задач по дням
+DAY_CACHE_SIZE = int(os.getenv('PLANNER_DAY_CACHE_SIZE', '10000'))
+DAY_CACHE_TTL = float(os.getenv('PLANNER_DAY_CACHE_TTL', '300'))
+
+# Постраничный вывод списка задач
+PAGE_SIZE = int(os.getenv('PLANNER_PAGE_SIZE', '20'))
+TASK_LINE_LIMIT = 150
+SEARCH_PAGE_SIZE = int(os.getenv('PLANNER_SEARCH_PAGE_SIZE', '10'))
+
+# Массовый импорт задач
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+IMPORT_MAX_TASK_LENGTH = 4096
+IMPORT_REPORTED_ERRORS = 20
+
+# Выгрузка задач: размер порции чтения из базы
+EXPORT_CHUNK_SIZE = 1000
+
+# Архивирование выполненных задач старше ARCHIVE_AFTER_DAYS дней (0 - не архивировать)
+ARCHIVE_AFTER_DAYS = int(os.getenv('PLANNER_ARCHIVE_AFTER_DAYS', '365'))
+ARCHIVE_INTERVAL = float(os.getenv('PLANNER_ARCHIVE_INTERVAL', '3600'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('PLANNER_ARCHIVE_BATCH_SIZE', '500'))
+ARCHIVE_VACUUM_PAGES = int(os.getenv('PLANNER_ARCHIVE_VACUUM_PAGES', '2000'))
+
+# Рассылка ежедневных напоминаний
+DEFAULT_TIMEZONE = os.getenv('PLANNER_TIMEZONE', 'UTC')
+DEFAULT_REMINDER_MINUTE = 7 * 60
+REMINDER_CONCURRENCY = int(os.getenv('PLANNER_REMINDER_CONCURRENCY', '20'))
+REMINDER_BATCH_SIZE = 1000
+
+# Исходящие сообщения: общий лимит бота и лимиты отдельных чатов
+# (сообщений в секунду и запас для коротких всплесков), число повторов
+# после ответа 429 и минимальная пауза перед повтором
+OUTBOUND_RATE = float(os.getenv('PLANNER_OUTBOUND_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('PLANNER_OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('PLANNER_OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_GROUP_RATE = float(os.getenv('PLANNER_OUTBOUND_GROUP_RATE_PER_MINUTE', '20')) / 60
+OUTBOUND_RETRIES = int(os.getenv('PLANNER_OUTBOUND_RETRIES', '3'))
+OUTBOUND_BACKOFF = float(os.getenv('PLANNER_OUTBOUND_BACKOFF', '1'))
+OUTBOUND_CHAT_BUCKETS = 10000
+
+# Групповая фиксация записей: транзакция закрывается каждые
+# WRITE_BATCH_DELAY секунд или по набору WRITE_BATCH_SIZE операций
+WRITE_BATCH_SIZE = int(os.getenv('PLANNER_WRITE_BATCH_SIZE', '100'))
+WRITE_BATCH_DELAY = float(os.getenv('PLANNER_WRITE_BATCH_DELAY_MS', '5')) / 1000
+
+# Метрики: HTTP-эндпоинт в формате Prometheus и/или периодический вывод в лог
+METRICS_PORT = int(os.getenv('PLANNER_METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('PLANNER_METRICS_LISTEN', '127.0.0.1')
+METRICS_DUMP_INTERVAL = float(os.getenv('PLANNER_METRICS_DUMP_INTERVAL', '0'))
+METRICS_ENABLED = bool(METRICS_PORT or METRICS_DUMP_INTERVAL or os.getenv('PLANNER_METRICS'))
+
+
+# Реестр метрик: счетчики и гистограммы с одной меткой.
+# При выключенных метриках инструментирование не устанавливается,
+# а оставшиеся проверки сводятся к чтению флага enabled.
+class Metrics:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, enabled: bool, prefix: str = 'planday'):
+        self.enabled = enabled
+        self.prefix = prefix
+        # имя -> (имя метки, {значение метки: значение})
+        self._counters = {}
+        # имя -> (имя метки, {значение метки: [счетчики бакетов, сумма, количество]})
+        self._histograms = {}
+        # функции, возвращающие {имя: значение} для мгновенных показателей
+        self._gauges = []
+        # Метрики пишут и цикл событий, и поток хранилища (TimedConnection)
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, label: str, value, amount: float = 1) -> None:
+        with self._lock:
+            series = self._counters.setdefault(name, (label, {}))[1]
+            series[value] = series.get(value, 0) + amount
+
+    def observe(self, name: str, label: str, value, seconds: float) -> None:
+        with self._lock:
+            series = self._histograms.setdefault(name, (label, {}))[1]
+            histogram = series.get(value)
+            if histogram is None:
+                histogram = series[value] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def add_gauges(self, provider) -> None:
+        self._gauges.append(provider)
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self) -> str:
+        # Снимок под блокировкой, форматирование - уже без нее
+        with self._lock:
+            counters = [(name, label, list(series.items())) for name, (label, series) in self._counters.items()]
+            histograms = [
+                (name, label, [(value, (list(buckets), total, count)) for value, (buckets, total, count) in series.items()])
+                for name, (label, series) in self._histograms.items()
+            ]
+        lines = []
+        for name, label, series in sorted(counters):
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            for value, amount in series:
+                lines.append(f'{self.prefix}_{name}{{{label}="{self._escape(value)}"}} {amount}')
+        for name, label, series in sorted(histograms):
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for value, (buckets, total, count) in series:
+                labels = f'{label}="{self._escape(value)}"'
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f'{self.prefix}_{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.prefix}_{name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'{self.prefix}_{name}_sum{{{labels}}} {total}')
+                lines.append(f'{self.prefix}_{name}_count{{{labels}}} {count}')
+        for provider in self._gauges:
+            for name, value in provider().items():
+                lines.append(f"# TYPE {self.prefix}_{name} gauge")
+                lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(METRICS_ENABLED)
+
+
+# Счетчик ошибок, записанных в лог, по функциям
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        metrics.inc('logged_errors_total', 'function', record.funcName)
+
+
+if METRICS_ENABLED:
+    logger.addHandler(ErrorCounter())
+
+
+# Соединение SQLite, замеряющее время каждого запроса
+class TimedConnection(sqlite3.Connection):
+    @staticmethod
+    def _statement(sql: str) -> str:
+        return " ".join(sql.split())[:120]
+
+    def _timed(self, method, sql: str, parameters):
+        if not metrics.enabled:
+            return method(sql, parameters)
+        started = clock.perf_counter()
+        try:
+            return method(sql, parameters)
+        except Exception:
+            metrics.inc('sql_errors_total', 'statement', self._statement(sql))
+            raise
+        finally:
+            metrics.observe('sql_seconds', 'statement', self._statement(sql), clock.perf_counter() - started)
 
-# Подключение к базе данных
-def init_db():
-    try:
-        conn = sqlite3.connect('planner.db')
-        cursor = conn.cursor()
-        cursor.execute('''
+    def execute(self, sql: str, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql: str, parameters):
+        return self._timed(super().executemany, sql, parameters)
+
+
+# HTTP-клиент Bot API с замером времени и ошибок каждого метода
+class TimedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = clock.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc('api_errors_total', 'method', api_method)
+            raise
+        finally:
+            metrics.observe('api_seconds', 'method', api_method, clock.perf_counter() - started)
+        if status >= 400:
+            metrics.inc('api_errors_total', 'method', api_method)
+        return status, payload
+
+
+# Замер времени обработчика и счетчик необработанных исключений
+def instrumented(name: str, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = clock.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('handler_errors_total', 'handler', name)
+            raise
+        finally:
+            metrics.observe('handler_seconds', 'handler', name, clock.perf_counter() - started)
+    return wrapper
+
+
+# Оборачивает колбэки всех зарегистрированных обработчиков, включая шаги диалогов
+def instrument_handlers(application) -> None:
+    def wrap(handler) -> None:
+        if isinstance(handler, ConversationHandler):
+            for nested in handler.entry_points + handler.fallbacks:
+                wrap(nested)
+            for state_handlers in handler.states.values():
+                for nested in state_handlers:
+                    wrap(nested)
+        else:
+            handler.callback = instrumented(handler.callback.__name__, handler.callback)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+
+# Триггеры, поддерживающие поисковый индекс tasks_fts в актуальном состоянии
+TASKS_FTS_TRIGGERS = [
+    '''
+        CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+            INSERT INTO tasks_fts (rowid, task, user_id) VALUES (new.id, new.task, new.user_id);
+        END
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+            INSERT INTO tasks_fts (tasks_fts, rowid, task, user_id) VALUES ('delete', old.id, old.task, old.user_id);
+        END
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF task, user_id ON tasks BEGIN
+            INSERT INTO tasks_fts (tasks_fts, rowid, task, user_id) VALUES ('delete', old.id, old.task, old.user_id);
+            INSERT INTO tasks_fts (rowid, task, user_id) VALUES (new.id, new.task, new.user_id);
+        END
+    ''',
+]
+
+
+# Миграции схемы. Номер версии хранится в PRAGMA user_version:
+# версия N означает, что применены первые N миграций из списка.
+# Новые миграции добавляются только в конец.
+MIGRATIONS = [
+    # 1: таблица задач
+    [
+        '''
             CREATE TABLE IF NOT EXISTS tasks (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -36,15 +333,2004 @@ def init_db():
                 task TEXT,
                 completed INTEGER DEFAULT 0
             )
-        ''')
-        conn.commit()
+        '''
+    ],
+    # 2: составной индекс для выборок задач пользователя за день
+    [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_date_completed "
+        "ON tasks (user_id, date, completed)"
+    ],
+    # 3: индекс для рассылки напоминаний по всем пользователям за день
+    [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_date_completed_user "
+        "ON tasks (date, completed, user_id)"
+    ],
+    # 4: подписки на ежедневные напоминания
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                user_id INTEGER PRIMARY KEY,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        '''
+    ],
+    # 5: часовой пояс и время напоминания (минуты от местной полуночи)
+    [
+        "ALTER TABLE subscriptions ADD COLUMN timezone TEXT",
+        "ALTER TABLE subscriptions ADD COLUMN remind_minute INTEGER",
+    ],
+    # 6: полнотекстовый поиск по тексту задач. Индекс внешний (content='tasks'):
+    # текст не дублируется, а триггеры поддерживают индекс на всех путях записи.
+    # user_id индексируется как отдельная колонка, чтобы ограничивать поиск владельцем.
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5("
+        "task, user_id, content='tasks', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        *TASKS_FTS_TRIGGERS,
+        "INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild')",
+    ],
+    # 7: архив выполненных задач. task_history объединяет горячую таблицу и архив;
+    # поисковый индекс и выгрузка читают через нее и видят архивные задачи
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS tasks_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                date TEXT,
+                task TEXT,
+                completed INTEGER,
+                archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_tasks_archive_user_date_completed "
+        "ON tasks_archive (user_id, date, completed)",
+        "CREATE VIEW IF NOT EXISTS task_history AS "
+        "SELECT id, user_id, date, task, completed FROM tasks "
+        "UNION ALL SELECT id, user_id, date, task, completed FROM tasks_archive",
+        "DROP TABLE IF EXISTS tasks_fts",
+        "CREATE VIRTUAL TABLE tasks_fts USING fts5("
+        "task, user_id, content='task_history', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild')",
+    ],
+    # 8: дата задачи как целый номер дня (date.toordinal(), 0001-01-01 = 1) вместо
+    # текста ГГГГ-ММ-ДД: индексы меньше, сравнения диапазонов - целочисленные.
+    # SQLite не меняет тип колонки, поэтому таблицы пересоздаются; id сохраняются,
+    # так что поисковый индекс остается верным, пересоздаются только триггеры.
+    # Даты переводит migration_day, а не julianday(): см. комментарий к ней.
+    # Счетчик AUTOINCREMENT переносится со старой таблицы: иначе он откатится к
+    # MAX(id) живых задач и выдаст заново id, уже лежащие в архиве.
+    [
+        "DROP VIEW task_history",
+        '''
+            CREATE TABLE tasks_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                day INTEGER,
+                task TEXT,
+                completed INTEGER DEFAULT 0
+            )
+        ''',
+        "INSERT INTO tasks_new (id, user_id, day, task, completed) "
+        "SELECT id, user_id, migration_day(date), task, completed FROM tasks",
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'tasks_new', 0 "
+        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'tasks_new')",
+        "UPDATE sqlite_sequence SET seq = (SELECT MAX(seq) FROM ("
+        "SELECT seq FROM sqlite_sequence WHERE name IN ('tasks', 'tasks_new') "
+        "UNION ALL SELECT MAX(id) FROM tasks UNION ALL SELECT MAX(id) FROM tasks_archive"
+        ")) WHERE name = 'tasks_new'",
+        "DROP TABLE tasks",
+        "ALTER TABLE tasks_new RENAME TO tasks",
+        "CREATE INDEX idx_tasks_user_day_completed ON tasks (user_id, day, completed)",
+        "CREATE INDEX idx_tasks_day_completed_user ON tasks (day, completed, user_id)",
+        *TASKS_FTS_TRIGGERS,
+        '''
+            CREATE TABLE tasks_archive_new (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                day INTEGER,
+                task TEXT,
+                completed INTEGER,
+                archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        "INSERT INTO tasks_archive_new (id, user_id, day, task, completed, archived_at) "
+        "SELECT id, user_id, migration_day(date), task, completed, archived_at "
+        "FROM tasks_archive",
+        "DROP TABLE tasks_archive",
+        "ALTER TABLE tasks_archive_new RENAME TO tasks_archive",
+        "CREATE INDEX idx_tasks_archive_user_day_completed ON tasks_archive (user_id, day, completed)",
+        "CREATE VIEW task_history AS "
+        "SELECT id, user_id, day, task, completed FROM tasks "
+        "UNION ALL SELECT id, user_id, day, task, completed FROM tasks_archive",
+    ],
+    # 9: повторяющиеся задачи. Правило хранится одной строкой и разворачивается
+    # в дни при чтении; end_day без даты окончания - MAX_DAY. Отметки, правки и
+    # удаления отдельных повторений - редкие строки исключений по (rule_id, day)
+    [
+        '''
+            CREATE TABLE recurring_rules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                kind TEXT,
+                start_day INTEGER,
+                end_day INTEGER,
+                task TEXT
+            )
+        ''',
+        "CREATE INDEX idx_rules_user_start_end ON recurring_rules (user_id, start_day, end_day)",
+        '''
+            CREATE TABLE recurring_exceptions (
+                rule_id INTEGER,
+                day INTEGER,
+                task TEXT,
+                completed INTEGER DEFAULT 0,
+                deleted INTEGER DEFAULT 0,
+                PRIMARY KEY (rule_id, day)
+            ) WITHOUT ROWID
+        ''',
+    ],
+    # 10: страницы дня листаются курсором по id, а диапазон дней упорядочен по
+    # (day, id): с индексом (user_id, day, id) обходится без сортировки
+    [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_day_id ON tasks (user_id, day, id)",
+    ],
+]
+
+# Страница поиска: rowid из tasks_fts в порядке bm25 (вес только у колонки task).
+# ORDER BY rank сортирует внутри FTS5, без временного B-дерева.
+SEARCH_RANKED = (
+    "SELECT rowid FROM tasks_fts WHERE tasks_fts MATCH ? AND rank MATCH 'bm25(1.0, 0.0)' "
+    "ORDER BY rank LIMIT ? OFFSET ?"
+)
+
+# Горячие запросы, которые обязаны идти по индексу.
+# План поиска по tasks_fts всегда начинается со SCAN виртуальной таблицы.
+HOT_QUERIES = {
+    'day_page': (
+        "SELECT id, task, completed FROM tasks WHERE user_id = ? AND day = ? AND id > ? ORDER BY id LIMIT ?",
+        (0, 730120, 0, 1)
+    ),
+    'day_prev_page': (
+        "SELECT id FROM tasks WHERE user_id = ? AND day = ? AND id <= ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+        (0, 730120, 0, 1)
+    ),
+    'day_range': (
+        "SELECT day, id, task, completed FROM tasks WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY day, id",
+        (0, 730120, 730126)
+    ),
+    'open_tasks': (
+        "SELECT task FROM tasks WHERE user_id = ? AND day = ? AND completed = 0",
+        (0, 730120)
+    ),
+    'user_history': (
+        "SELECT id, day, task, completed FROM task_history WHERE user_id = ? ORDER BY day, completed, id",
+        (0,)
+    ),
+    'task_by_id': (
+        "SELECT day, task, completed FROM task_history WHERE id = ? AND user_id = ?",
+        (0, 0)
+    ),
+    'archive_candidates': (
+        "SELECT id FROM tasks WHERE day < ? AND completed = 1 LIMIT ?",
+        (730120, 1)
+    ),
+    'open_tasks_for_users': (
+        "SELECT user_id, task FROM tasks WHERE user_id IN (?, ?) AND day = ? AND completed = 0 "
+        "ORDER BY user_id, id",
+        (0, 1, 730120)
+    ),
+    'rules_for_users': (
+        "SELECT id, user_id, kind, start_day, end_day, task FROM recurring_rules "
+        "WHERE user_id IN (?, ?) AND start_day <= ? AND end_day >= ?",
+        (0, 1, 730126, 730120)
+    ),
+    'search_ranked': (
+        SEARCH_RANKED,
+        ('user_id:"0" AND task:("plan"*)', 1, 0)
+    ),
+    'search_rows': (
+        "SELECT id, day, task, completed FROM tasks WHERE id IN (?, ?) "
+        "UNION ALL SELECT id, day, task, completed FROM tasks_archive WHERE id IN (?, ?)",
+        (0, 1, 0, 1)
+    ),
+    'rule_exceptions': (
+        "SELECT rule_id, day, task, completed, deleted FROM recurring_exceptions "
+        "WHERE rule_id IN (?, ?) AND day BETWEEN ? AND ?",
+        (0, 1, 730120, 730126)
+    ),
+}
+
+
+# Номер дня для текстовой даты задачи (миграция 8). Старые версии проверяли дату
+# через strptime, но сохраняли текст как введен, поэтому в базе бывают даты без
+# ведущих нулей ('2025-1-5'). julianday() возвращает для них NULL, так что разбор
+# делается в Python; неразборная дата останавливает миграцию, а не пишет NULL.
+def migration_day(text) -> int:
+    try:
+        return parse_day(text)
+    except (TypeError, ValueError):
+        logger.error(f"Cannot convert task date {text!r} to a day number")
+        raise
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    conn.create_function('migration_day', 1, migration_day, deterministic=True)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info(f"Applied database migration {number}")
+    return len(MIGRATIONS)
+
+
+# Шаги плана, которые горячему запросу не разрешены: сортировка во временном
+# B-дереве, материализация подзапроса или представления, автоматический индекс
+PLAN_PROBLEMS = ('USE TEMP B-TREE', 'MATERIALIZE', 'AUTOMATIC')
+
+
+# Проверка планов запросов: возвращает запросы, которые сканируют таблицу,
+# сортируют без индекса или строят временные структуры
+def check_query_plans(conn: sqlite3.Connection) -> dict:
+    problems = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        # Виртуальная таблица FTS5 отвечает на MATCH своим индексом, хотя план пишет SCAN
+        indexed = [detail for detail in plan if 'USING' in detail or 'VIRTUAL TABLE INDEX' in detail]
+        scans = [detail for detail in plan if detail.startswith('SCAN') and 'VIRTUAL TABLE INDEX' not in detail]
+        if not indexed or scans or any(marker in detail for detail in plan for marker in PLAN_PROBLEMS):
+            problems[name] = plan
+    return problems
+
+
+# Подключение к базе данных
+def init_db(path: str = DB_PATH):
+    try:
+        conn = sqlite3.connect(path, isolation_level=None)
+        # Страницы, освобожденные архивированием, возвращаются файлу через
+        # incremental_vacuum. На существующей базе режим включается только
+        # полным VACUUM, он выполняется один раз.
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA journal_mode = WAL")
+        version = migrate(conn)
+
+        for name, plan in check_query_plans(conn).items():
+            logger.warning(f"Query '{name}' is not served by an index: {plan}")
+
         conn.close()
-        logger.info("Database initialized successfully")
+        logger.info(f"Database initialized successfully (schema version {version})")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
 
 
-init_db()
+# Очередь записей с групповой фиксацией.
+# Изменения от разных пользователей собираются в пачку и применяются в одной
+# транзакции (один fsync на пачку). Каждая операция выполняется в своей точке
+# сохранения, поэтому ошибка одной операции не откатывает остальные.
+# Вызывающий код ждет подтверждения именно своей записи.
+class WriteQueue:
+    def __init__(self, run, connection, batch_size: int, delay: float):
+        self._run = run
+        self._connection = connection
+        self.batch_size = batch_size
+        self.delay = delay
+        self._queue = None
+        self._worker = None
+        self.batches = 0
+        self.operations = 0
+        self.max_batch = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+
+    async def submit(self, func, *args):
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._work())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((func, args, future))
+        return await future
+
+    async def _work(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.delay)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._commit(batch)
+
+    def _apply(self, batch: list) -> list:
+        conn = self._connection()
+        results = []
+        try:
+            conn.execute("BEGIN")
+            for func, args, future in batch:
+                conn.execute("SAVEPOINT operation")
+                try:
+                    results.append((True, func(conn, *args)))
+                    conn.execute("RELEASE operation")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO operation")
+                    conn.execute("RELEASE operation")
+                    results.append((False, e))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return results
+
+    async def _commit(self, batch: list) -> None:
+        started = clock.monotonic()
+        try:
+            results = await self._run(self._apply, batch)
+        except Exception as e:
+            logger.error(f"Error committing write batch of {len(batch)}: {e}")
+            results = [(False, e)] * len(batch)
+        elapsed = clock.monotonic() - started
+
+        self.batches += 1
+        self.operations += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.commit_seconds += elapsed
+        self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+
+        for (func, args, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    async def close(self) -> None:
+        if self._worker is None:
+            return
+        # Дожидаемся записи всего, что уже стоит в очереди
+        while not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._commit(batch)
+        self._worker.cancel()
+        self._worker = None
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'batches': self.batches,
+            'operations': self.operations,
+            'avg_batch': self.operations / self.batches if self.batches else 0.0,
+            'max_batch': self.max_batch,
+            'avg_commit_seconds': self.commit_seconds / self.batches if self.batches else 0.0,
+            'max_commit_seconds': self.max_commit_seconds,
+        }
+
+
+# Повторяющиеся задачи. Повторение правила в конкретный день имеет id вида
+# "r<правило>.<день>" и в обработчиках проходит там же, где id обычной задачи.
+RULE_KINDS = {
+    'daily': "каждый день",
+    'weekdays': "по будням",
+    'weekly': "каждую неделю",
+    'monthly': "каждый месяц",
+}
+MAX_DAY = datetime.max.toordinal()
+OCCURRENCE_ID = re.compile(r"r(\d+)\.(\d+)$")
+
+
+def parse_occurrence(task_id):
+    # (rule_id, day) для id повторения или None для обычной задачи
+    match = OCCURRENCE_ID.match(str(task_id))
+    return (int(match[1]), int(match[2])) if match else None
+
+
+def rule_matches(kind: str, start: int, day: int) -> bool:
+    if kind == 'daily':
+        return True
+    if kind == 'weekdays':
+        return (day - 1) % 7 < 5
+    if kind == 'weekly':
+        return (day - start) % 7 == 0
+    # monthly: то же число месяца; в месяцах без такого числа повторения нет
+    return datetime.fromordinal(day).day == datetime.fromordinal(start).day
+
+
+def rule_occurs(rule: tuple, day: int) -> bool:
+    kind, start, end = rule
+    return start <= day <= end and rule_matches(kind, start, day)
+
+
+# Развертывание правил в повторения за дни first..last.
+# rules - строки (id, user_id, kind, start_day, end_day, task),
+# exceptions - {(rule_id, day): (task или None, completed, deleted)}.
+# Результат: {(user_id, day): [(id повторения, текст, completed)]}
+def expand_rules(rules, exceptions: dict, first: int, last: int) -> dict:
+    occurrences = {}
+    for rule_id, user_id, kind, start, end, task_text in rules:
+        for day in range(max(start, first), min(end, last) + 1):
+            if not rule_matches(kind, start, day):
+                continue
+            text, completed, deleted = exceptions.get((rule_id, day), (None, 0, 0))
+            if deleted:
+                continue
+            occurrences.setdefault((user_id, day), []).append(
+                (f"r{rule_id}.{day}", text if text is not None else task_text, completed)
+            )
+    return occurrences
+
+
+# Интерфейс хранилища задач и подписок. Обработчики работают только с ним,
+# реализация выбирается настройкой PLANNER_STORAGE.
+# Все операции с задачей принимают user_id: по нему выбирается шард,
+# а id задачи уникален только в пределах шарда.
+class TaskStorage(ABC):
+    @abstractmethod
+    async def add_task(self, user_id: int, day: int, task_text: str) -> int: ...
+
+    # rows - (day, task, completed) задач одного пользователя
+    @abstractmethod
+    async def import_tasks(self, user_id: int, rows) -> int: ...
+
+    @abstractmethod
+    async def get_day_page(self, user_id: int, day: int, after_id: int = 0, limit: int = PAGE_SIZE) -> tuple: ...
+
+    @abstractmethod
+    async def get_day_range(self, user_id: int, start: int, end: int, limit: int = PAGE_SIZE) -> dict: ...
+
+    @abstractmethod
+    async def search_tasks(self, user_id: int, words: list, offset: int = 0, limit: int = SEARCH_PAGE_SIZE) -> tuple: ...
+
+    @abstractmethod
+    async def get_open_tasks(self, user_id: int, day: int) -> list: ...
+
+    @abstractmethod
+    async def get_task(self, task_id, user_id: int): ...
+
+    # Изменение задачи возвращает ее дату или None, если задача не найдена.
+    # Для id повторения изменение записывается исключением правила
+    @abstractmethod
+    async def complete_task(self, task_id, user_id: int): ...
+
+    @abstractmethod
+    async def update_task_text(self, task_id, user_id: int, task_text: str): ...
+
+    @abstractmethod
+    async def delete_task(self, task_id, user_id: int): ...
+
+    @abstractmethod
+    async def add_rule(self, user_id: int, kind: str, start: int, end: int, task_text: str) -> int: ...
+
+    # Правило перестает повторяться после дня day; False, если правило не найдено
+    @abstractmethod
+    async def end_rule(self, rule_id: int, user_id: int, day: int) -> bool: ...
+
+    # Повторения правил пользователей за дни first..last, см. expand_rules
+    @abstractmethod
+    async def get_occurrences(self, user_ids: list, first: int, last: int) -> dict: ...
+
+    @abstractmethod
+    async def add_subscription(self, user_id: int) -> None: ...
+
+    @abstractmethod
+    async def set_timezone(self, user_id: int, timezone_name: str) -> None: ...
+
+    @abstractmethod
+    async def set_reminder_minute(self, user_id: int, minute: int) -> None: ...
+
+    @abstractmethod
+    async def load_subscriptions(self) -> list: ...
+
+    # Асинхронные генераторы: (user_id, [задачи]) и порции строк истории
+    @abstractmethod
+    def iter_open_tasks_for_users(self, day: int, user_ids: list, batch_size: int = REMINDER_BATCH_SIZE): ...
+
+    @abstractmethod
+    def iter_user_tasks(self, user_id: int, batch_size: int = EXPORT_CHUNK_SIZE): ...
+
+    @abstractmethod
+    async def archive_tasks(self, cutoff: int, limit: int = ARCHIVE_BATCH_SIZE) -> tuple: ...
+
+    @abstractmethod
+    async def vacuum(self, pages: int = ARCHIVE_VACUUM_PAGES) -> int: ...
+
+    @abstractmethod
+    def stats(self) -> dict: ...
+
+    @abstractmethod
+    async def close(self) -> None: ...
+
+
+# Асинхронное хранилище задач.
+# Одно долгоживущее соединение обслуживается выделенным потоком,
+# поэтому запросы к SQLite не блокируют цикл событий бота.
+class SQLiteStorage(TaskStorage):
+    def __init__(self, path: str):
+        self.path = path
+        init_db(path)
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='planner-db')
+        self.writes = WriteQueue(self._run, self._connection, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY)
+
+    def _connection(self) -> sqlite3.Connection:
+        # Вызывается только из потока хранилища
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, factory=TimedConnection)
+            # В режиме WAL fsync нужен только на контрольных точках
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        return self._connection().execute(sql, params).fetchall()
+
+    def _fetchone(self, sql: str, params: tuple):
+        return self._connection().execute(sql, params).fetchone()
+
+    # Операции записи выполняются очередью WriteQueue внутри общей транзакции
+    @staticmethod
+    def _insert_task(conn: sqlite3.Connection, user_id: int, day: int, task_text: str) -> int:
+        cursor = conn.execute(
+            "INSERT INTO tasks (user_id, day, task) VALUES (?, ?, ?)",
+            (user_id, day, task_text)
+        )
+        return cursor.lastrowid
+
+    @staticmethod
+    def _insert_tasks(conn: sqlite3.Connection, user_id: int, rows) -> int:
+        # rows может быть генератором: строки разбираются по мере вставки
+        cursor = conn.executemany(
+            "INSERT INTO tasks (user_id, day, task, completed) VALUES (?, ?, ?, ?)",
+            ((user_id, day, task_text, completed) for day, task_text, completed in rows)
+        )
+        return cursor.rowcount
+
+    @staticmethod
+    def _modify_task(conn: sqlite3.Connection, sql: str, params: tuple, task_id, user_id: int):
+        # Возвращает дату задачи или None, если задача не найдена.
+        # sql выполняется над {table}: tasks или tasks_archive, где лежит задача
+        row = conn.execute(
+            "SELECT day FROM tasks WHERE id = ? AND user_id = ?",
+            (task_id, user_id)
+        ).fetchone()
+        if row is not None:
+            conn.execute(sql.format(table='tasks'), params)
+            return row[0]
+        row = conn.execute(
+            "SELECT day, task FROM tasks_archive WHERE id = ? AND user_id = ?",
+            (task_id, user_id)
+        ).fetchone()
+        if row is None:
+            return None
+        # У архива нет триггеров: поисковый индекс обновляется здесь
+        conn.execute(
+            "INSERT INTO tasks_fts (tasks_fts, rowid, task, user_id) VALUES ('delete', ?, ?, ?)",
+            (task_id, row[1], user_id)
+        )
+        conn.execute(sql.format(table='tasks_archive'), params)
+        conn.execute(
+            "INSERT INTO tasks_fts (rowid, task, user_id) SELECT id, task, user_id FROM tasks_archive WHERE id = ?",
+            (task_id,)
+        )
+        return row[0]
+
+    @staticmethod
+    def _insert_rule(conn: sqlite3.Connection, user_id: int, kind: str, start: int, end: int, task_text: str) -> int:
+        cursor = conn.execute(
+            "INSERT INTO recurring_rules (user_id, kind, start_day, end_day, task) VALUES (?, ?, ?, ?, ?)",
+            (user_id, kind, start, end, task_text)
+        )
+        return cursor.lastrowid
+
+    @staticmethod
+    def _end_rule(conn: sqlite3.Connection, rule_id: int, user_id: int, day: int) -> bool:
+        cursor = conn.execute(
+            "UPDATE recurring_rules SET end_day = ? WHERE id = ? AND user_id = ? AND end_day > ?",
+            (day, rule_id, user_id, day)
+        )
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def _modify_occurrence(conn: sqlite3.Connection, rule_id: int, day: int, user_id: int, column: str, value):
+        # Возвращает день повторения или None, если у правила нет повторения в этот день
+        rule = conn.execute(
+            "SELECT kind, start_day, end_day FROM recurring_rules WHERE id = ? AND user_id = ?",
+            (rule_id, user_id)
+        ).fetchone()
+        if rule is None or not rule_occurs(rule, day):
+            return None
+        deleted = conn.execute(
+            "SELECT deleted FROM recurring_exceptions WHERE rule_id = ? AND day = ?",
+            (rule_id, day)
+        ).fetchone()
+        if deleted is not None and deleted[0]:
+            return None
+        conn.execute(
+            f"INSERT INTO recurring_exceptions (rule_id, day, {column}) VALUES (?, ?, ?) "
+            f"ON CONFLICT (rule_id, day) DO UPDATE SET {column} = excluded.{column}",
+            (rule_id, day, value)
+        )
+        return day
+
+    @staticmethod
+    def _archive_tasks(conn: sqlite3.Connection, cutoff: int, limit: int) -> list:
+        # Перенос пачки выполненных задач старше cutoff в архив.
+        # Возвращает (число перенесенных задач, затронутые дни (user_id, day) для сброса кэша)
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM tasks WHERE day < ? AND completed = 1 LIMIT ?", (cutoff, limit)
+        )]
+        if not ids:
+            return 0, []
+        placeholders = ", ".join("?" * len(ids))
+        days = conn.execute(
+            f"SELECT DISTINCT user_id, day FROM tasks WHERE id IN ({placeholders})", ids
+        ).fetchall()
+        conn.execute(
+            "INSERT INTO tasks_archive (id, user_id, day, task, completed) "
+            f"SELECT id, user_id, day, task, completed FROM tasks WHERE id IN ({placeholders})",
+            ids
+        )
+        # Триггер удаления убирает задачи из поискового индекса, возвращаем их уже из архива
+        conn.execute(f"DELETE FROM tasks WHERE id IN ({placeholders})", ids)
+        conn.execute(
+            f"INSERT INTO tasks_fts (rowid, task, user_id) SELECT id, task, user_id FROM tasks_archive "
+            f"WHERE id IN ({placeholders})",
+            ids
+        )
+        return len(ids), days
+
+    def _incremental_vacuum(self, pages: int) -> int:
+        conn = self._connection()
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # Прагма освобождает по странице за шаг, а execute делает только один шаг;
+        # executescript выполняет ее до конца
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def _open_stream(self, sql: str, params: tuple) -> sqlite3.Cursor:
+        # Отдельное соединение читает согласованный снимок (WAL) и не мешает
+        # остальным запросам, которые выполняются между порциями
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=TimedConnection)
+        return conn.execute(sql, params)
+
+    @staticmethod
+    def _close_stream(cursor: sqlite3.Cursor) -> None:
+        connection = cursor.connection
+        cursor.close()
+        connection.close()
+
+    async def _stream(self, sql: str, params: tuple, batch_size: int):
+        cursor = await self._run(self._open_stream, sql, params)
+        try:
+            while True:
+                rows = await self._run(cursor.fetchmany, batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await self._run(self._close_stream, cursor)
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def add_task(self, user_id: int, day: int, task_text: str) -> int:
+        return await self.writes.submit(self._insert_task, user_id, day, task_text)
+
+    async def import_tasks(self, user_id: int, rows) -> int:
+        # Все строки вставляются одной операцией в одной транзакции
+        return await self.writes.submit(self._insert_tasks, user_id, rows)
+
+    def _day_page(self, user_id: int, day: int, after_id: int, limit: int) -> tuple:
+        conn = self._connection()
+        # Строка сверх лимита показывает, что есть следующая страница
+        rows = conn.execute(
+            "SELECT id, task, completed FROM tasks WHERE user_id = ? AND day = ? AND id > ? ORDER BY id LIMIT ?",
+            (user_id, day, after_id, limit + 1)
+        ).fetchall()
+        prev_cursor = None
+        if after_id:
+            # Курсор предыдущей страницы - id задачи, стоящей перед ней
+            row = conn.execute(
+                "SELECT id FROM tasks WHERE user_id = ? AND day = ? AND id <= ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (user_id, day, after_id, limit)
+            ).fetchone()
+            prev_cursor = row[0] if row else 0
+        return rows[:limit], len(rows) > limit, prev_cursor
+
+    async def get_day_page(self, user_id: int, day: int, after_id: int = 0, limit: int = PAGE_SIZE) -> tuple:
+        # Страница задач дня по курсору (id последней задачи предыдущей страницы):
+        # (задачи, есть ли следующая страница, курсор предыдущей страницы или None)
+        return await self._run(self._day_page, user_id, day, after_id, limit)
+
+    def _day_range(self, user_id: int, start: int, end: int, limit: int) -> dict:
+        cursor = self._connection().execute(
+            "SELECT day, id, task, completed FROM tasks WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY day, id",
+            (user_id, start, end)
+        )
+        days = {}
+        for day, task_id, task_text, completed in cursor:
+            entry = days.get(day)
+            if entry is None:
+                # [первая страница задач, открытых, выполненных]
+                entry = days[day] = [[], 0, 0]
+            if len(entry[0]) <= limit:
+                entry[0].append((task_id, task_text, completed))
+            entry[2 if completed else 1] += 1
+        return days
+
+    async def get_day_range(self, user_id: int, start: int, end: int, limit: int = PAGE_SIZE) -> dict:
+        # Диапазон дней одним запросом: день -> [первая страница (с лишней строкой), открытых, выполненных]
+        return await self._run(self._day_range, user_id, start, end, limit)
+
+    async def search_tasks(self, user_id: int, words: list, offset: int = 0, limit: int = SEARCH_PAGE_SIZE) -> tuple:
+        # Все слова обязательны, последнее ищется по префиксу; поиск только среди задач владельца
+        terms = " AND ".join('"' + word.replace('"', '""') + '"' for word in words)
+        expression = f'user_id:"{int(user_id)}" AND task:({terms}*)'
+        rows = await self._run(self._search, expression, offset, limit + 1)
+        return rows[:limit], len(rows) > limit
+
+    def _search(self, expression: str, offset: int, limit: int) -> list:
+        # Сначала страница rowid из индекса FTS в порядке релевантности, затем
+        # строки по первичному ключу: соединение с представлением task_history
+        # материализует обе таблицы целиком
+        conn = self._connection()
+        ids = [row[0] for row in conn.execute(SEARCH_RANKED, (expression, limit, offset))]
+        if not ids:
+            return []
+        marks = ", ".join("?" * len(ids))
+        rows = {
+            row[0]: row for row in conn.execute(
+                f"SELECT id, day, task, completed FROM tasks WHERE id IN ({marks}) "
+                f"UNION ALL SELECT id, day, task, completed FROM tasks_archive WHERE id IN ({marks})",
+                ids + ids
+            )
+        }
+        return [rows[task_id] for task_id in ids if task_id in rows]
+
+    async def get_open_tasks(self, user_id: int, day: int) -> list:
+        rows = await self._run(
+            self._fetchall,
+            "SELECT task FROM tasks WHERE user_id = ? AND day = ? AND completed = 0",
+            (user_id, day)
+        )
+        return [row[0] for row in rows]
+
+    async def add_rule(self, user_id: int, kind: str, start: int, end: int, task_text: str) -> int:
+        return await self.writes.submit(self._insert_rule, user_id, kind, start, end, task_text)
+
+    async def end_rule(self, rule_id: int, user_id: int, day: int) -> bool:
+        return await self.writes.submit(self._end_rule, rule_id, user_id, day)
+
+    def _occurrences(self, user_ids: list, first: int, last: int) -> dict:
+        # Правила, пересекающие диапазон, находятся по индексу (user_id, start_day, end_day);
+        # исключения читаются только для найденных правил и только за диапазон
+        conn = self._connection()
+        chunk_size = 500
+        rules = []
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            rules.extend(conn.execute(
+                "SELECT id, user_id, kind, start_day, end_day, task FROM recurring_rules "
+                f"WHERE user_id IN ({placeholders}) AND start_day <= ? AND end_day >= ?",
+                (*chunk, last, first)
+            ))
+        exceptions = {}
+        for start in range(0, len(rules), chunk_size):
+            chunk = [rule[0] for rule in rules[start:start + chunk_size]]
+            placeholders = ", ".join("?" * len(chunk))
+            for rule_id, day, task_text, completed, deleted in conn.execute(
+                "SELECT rule_id, day, task, completed, deleted FROM recurring_exceptions "
+                f"WHERE rule_id IN ({placeholders}) AND day BETWEEN ? AND ?",
+                (*chunk, first, last)
+            ):
+                exceptions[(rule_id, day)] = (task_text, completed, deleted)
+        return expand_rules(rules, exceptions, first, last)
+
+    async def get_occurrences(self, user_ids: list, first: int, last: int) -> dict:
+        return await self._run(self._occurrences, user_ids, first, last)
+
+    @staticmethod
+    def _insert_subscription(conn: sqlite3.Connection, user_id: int) -> None:
+        conn.execute("INSERT OR IGNORE INTO subscriptions (user_id) VALUES (?)", (user_id,))
+
+    @staticmethod
+    def _update_subscription(conn: sqlite3.Connection, user_id: int, column: str, value) -> None:
+        conn.execute(
+            f"INSERT INTO subscriptions (user_id, {column}) VALUES (?, ?) "
+            f"ON CONFLICT (user_id) DO UPDATE SET {column} = excluded.{column}",
+            (user_id, value)
+        )
+
+    def _load_subscriptions(self) -> list:
+        cursor = self._connection().execute("SELECT user_id, timezone, remind_minute FROM subscriptions")
+        subscriptions = []
+        while True:
+            rows = cursor.fetchmany(REMINDER_BATCH_SIZE * 10)
+            if not rows:
+                return subscriptions
+            subscriptions.extend(rows)
+
+    async def add_subscription(self, user_id: int) -> None:
+        await self.writes.submit(self._insert_subscription, user_id)
+
+    async def set_timezone(self, user_id: int, timezone_name: str) -> None:
+        await self.writes.submit(self._update_subscription, user_id, 'timezone', timezone_name)
+
+    async def set_reminder_minute(self, user_id: int, minute: int) -> None:
+        await self.writes.submit(self._update_subscription, user_id, 'remind_minute', minute)
+
+    async def load_subscriptions(self) -> list:
+        return await self._run(self._load_subscriptions)
+
+    async def iter_open_tasks_for_users(self, day: int, user_ids: list, batch_size: int = REMINDER_BATCH_SIZE):
+        # Открытые задачи группы пользователей, сгруппированные по user_id.
+        # Список пользователей режется на части, чтобы не упереться в лимит параметров SQLite.
+        chunk_size = 500
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            current_user, tasks = None, []
+            async for rows in self._stream(
+                f"SELECT user_id, task FROM tasks WHERE user_id IN ({placeholders}) "
+                f"AND day = ? AND completed = 0 ORDER BY user_id, id",
+                (*chunk, day), batch_size
+            ):
+                for user_id, task_text in rows:
+                    if user_id != current_user:
+                        if tasks:
+                            yield current_user, tasks
+                        current_user, tasks = user_id, []
+                    tasks.append(task_text)
+            if tasks:
+                yield current_user, tasks
+
+    async def iter_user_tasks(self, user_id: int, batch_size: int = EXPORT_CHUNK_SIZE):
+        # Вся история пользователя порциями, включая архив. Обе таблицы читаются
+        # по индексам в нужном порядке и сливаются (MERGE), без сортировки в памяти
+        async for rows in self._stream(
+            "SELECT id, day, task, completed FROM task_history WHERE user_id = ? ORDER BY day, completed, id",
+            (user_id,), batch_size
+        ):
+            yield rows
+
+    async def get_task(self, task_id, user_id: int):
+        occurrence = parse_occurrence(task_id)
+        if occurrence is not None:
+            rule_id, day = occurrence
+            occurrences = await self.get_occurrences([user_id], day, day)
+            for found_id, task_text, completed in occurrences.get((user_id, day), []):
+                if found_id == f"r{rule_id}.{day}":
+                    return day, task_text, completed
+            return None
+        return await self._run(
+            self._fetchone,
+            "SELECT day, task, completed FROM task_history WHERE id = ? AND user_id = ?",
+            (task_id, user_id)
+        )
+
+    async def complete_task(self, task_id, user_id: int):
+        occurrence = parse_occurrence(task_id)
+        if occurrence is not None:
+            return await self.writes.submit(self._modify_occurrence, *occurrence, user_id, 'completed', 1)
+        return await self.writes.submit(
+            self._modify_task,
+            "UPDATE {table} SET completed = 1 WHERE id = ? AND user_id = ?",
+            (task_id, user_id), task_id, user_id
+        )
+
+    async def update_task_text(self, task_id, user_id: int, task_text: str):
+        occurrence = parse_occurrence(task_id)
+        if occurrence is not None:
+            return await self.writes.submit(self._modify_occurrence, *occurrence, user_id, 'task', task_text)
+        return await self.writes.submit(
+            self._modify_task,
+            "UPDATE {table} SET task = ? WHERE id = ? AND user_id = ?",
+            (task_text, task_id, user_id), task_id, user_id
+        )
+
+    async def delete_task(self, task_id, user_id: int):
+        occurrence = parse_occurrence(task_id)
+        if occurrence is not None:
+            return await self.writes.submit(self._modify_occurrence, *occurrence, user_id, 'deleted', 1)
+        return await self.writes.submit(
+            self._modify_task,
+            "DELETE FROM {table} WHERE id = ? AND user_id = ?",
+            (task_id, user_id), task_id, user_id
+        )
+
+    async def archive_tasks(self, cutoff: int, limit: int = ARCHIVE_BATCH_SIZE) -> tuple:
+        return await self.writes.submit(self._archive_tasks, cutoff, limit)
+
+    async def vacuum(self, pages: int = ARCHIVE_VACUUM_PAGES) -> int:
+        # Возвращает число страниц, отданных файловой системе
+        return await self._run(self._incremental_vacuum, pages)
+
+    def stats(self) -> dict:
+        return self.writes.stats()
+
+    async def close(self) -> None:
+        await self.writes.close()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+
+# Хранилище в памяти процесса с той же семантикой, что и SQLite:
+# курсоры страниц по id, архив, поиск по словам (последнее - по префиксу).
+# Данные не переживают перезапуск; предназначено для тестов и бенчмарков.
+class MemoryStorage(TaskStorage):
+    def __init__(self):
+        self._next_id = 0
+        # id -> [user_id, day, task, completed]
+        self._tasks = {}
+        self._archive = {}
+        # user_id -> {day: [id, ...] по возрастанию}
+        self._days = {}
+        # user_id -> [timezone, remind_minute]
+        self._subscriptions = {}
+        self._next_rule_id = 0
+        # rule_id -> (id, user_id, kind, start_day, end_day, task)
+        self._rules = {}
+        # (rule_id, day) -> [task или None, completed, deleted]
+        self._exceptions = {}
+
+    def _insert(self, user_id: int, day: int, task_text: str, completed: int) -> int:
+        self._next_id += 1
+        self._tasks[self._next_id] = [user_id, day, task_text, completed]
+        self._days.setdefault(user_id, {}).setdefault(day, []).append(self._next_id)
+        return self._next_id
+
+    def _remove(self, task_id: int) -> list:
+        row = self._tasks.pop(task_id)
+        ids = self._days[row[0]][row[1]]
+        ids.remove(task_id)
+        if not ids:
+            del self._days[row[0]][row[1]]
+        return row
+
+    def _own(self, task_id, user_id: int):
+        # Задача пользователя из текущих или из архива
+        row = self._tasks.get(int(task_id))
+        if row is None:
+            row = self._archive.get(int(task_id))
+        return row if row is not None and row[0] == user_id else None
+
+    async def add_task(self, user_id: int, day: int, task_text: str) -> int:
+        return self._insert(user_id, day, task_text, 0)
+
+    async def import_tasks(self, user_id: int, rows) -> int:
+        count = 0
+        for day, task_text, completed in rows:
+            self._insert(user_id, day, task_text, completed)
+            count += 1
+        return count
+
+    async def get_day_page(self, user_id: int, day: int, after_id: int = 0, limit: int = PAGE_SIZE) -> tuple:
+        ids = self._days.get(user_id, {}).get(day, [])
+        position = bisect.bisect_right(ids, after_id)
+        page = [(task_id, *self._tasks[task_id][2:]) for task_id in ids[position:position + limit]]
+        prev_cursor = None
+        if after_id:
+            prev_cursor = ids[position - 1 - limit] if position > limit else 0
+        return page, len(ids) > position + limit, prev_cursor
+
+    async def get_day_range(self, user_id: int, start: int, end: int, limit: int = PAGE_SIZE) -> dict:
+        days = {}
+        for day, ids in sorted(self._days.get(user_id, {}).items()):
+            if start <= day <= end:
+                rows = [self._tasks[task_id] for task_id in ids]
+                done = sum(1 for row in rows if row[3])
+                days[day] = [
+                    [(task_id, self._tasks[task_id][2], self._tasks[task_id][3]) for task_id in ids[:limit + 1]],
+                    len(rows) - done, done
+                ]
+        return days
+
+    async def search_tasks(self, user_id: int, words: list, offset: int = 0, limit: int = SEARCH_PAGE_SIZE) -> tuple:
+        words = [word.lower() for word in words]
+        found = []
+        for table in (self._tasks, self._archive):
+            for task_id, (owner, day, task_text, completed) in table.items():
+                if owner != user_id:
+                    continue
+                tokens = SEARCH_WORD.findall(task_text.lower())
+                if all(word in tokens for word in words[:-1]) and any(token.startswith(words[-1]) for token in tokens):
+                    found.append((task_id, day, task_text, completed))
+        found.sort()
+        return found[offset:offset + limit], len(found) > offset + limit
+
+    async def get_open_tasks(self, user_id: int, day: int) -> list:
+        return [
+            self._tasks[task_id][2] for task_id in self._days.get(user_id, {}).get(day, [])
+            if not self._tasks[task_id][3]
+        ]
+
+    def _occurrence(self, task_id, user_id: int):
+        # (rule_id, day, исключение) для существующего повторения или None
+        rule_id, day = parse_occurrence(task_id)
+        rule = self._rules.get(rule_id)
+        if rule is None or rule[1] != user_id or not rule_occurs(rule[2:5], day):
+            return None
+        exception = self._exceptions.get((rule_id, day), [None, 0, 0])
+        return None if exception[2] else (rule, day, exception)
+
+    def _modify_occurrence(self, task_id, user_id: int, position: int, value):
+        found = self._occurrence(task_id, user_id)
+        if found is None:
+            return None
+        rule, day, exception = found
+        exception[position] = value
+        self._exceptions[(rule[0], day)] = exception
+        return day
+
+    async def add_rule(self, user_id: int, kind: str, start: int, end: int, task_text: str) -> int:
+        self._next_rule_id += 1
+        self._rules[self._next_rule_id] = (self._next_rule_id, user_id, kind, start, end, task_text)
+        return self._next_rule_id
+
+    async def end_rule(self, rule_id: int, user_id: int, day: int) -> bool:
+        rule = self._rules.get(rule_id)
+        if rule is None or rule[1] != user_id or rule[4] <= day:
+            return False
+        self._rules[rule_id] = (*rule[:4], day, rule[5])
+        return True
+
+    async def get_occurrences(self, user_ids: list, first: int, last: int) -> dict:
+        users = set(user_ids)
+        rules = [rule for rule in self._rules.values() if rule[1] in users and rule[3] <= last and rule[4] >= first]
+        return expand_rules(rules, self._exceptions, first, last)
+
+    async def get_task(self, task_id, user_id: int):
+        if parse_occurrence(task_id) is not None:
+            found = self._occurrence(task_id, user_id)
+            if found is None:
+                return None
+            rule, day, exception = found
+            return day, exception[0] if exception[0] is not None else rule[5], exception[1]
+        row = self._own(task_id, user_id)
+        if row is None:
+            return None
+        return tuple(row[1:])
+
+    async def complete_task(self, task_id, user_id: int):
+        if parse_occurrence(task_id) is not None:
+            return self._modify_occurrence(task_id, user_id, 1, 1)
+        row = self._own(task_id, user_id)
+        if row is None:
+            return None
+        row[3] = 1
+        return row[1]
+
+    async def update_task_text(self, task_id, user_id: int, task_text: str):
+        if parse_occurrence(task_id) is not None:
+            return self._modify_occurrence(task_id, user_id, 0, task_text)
+        row = self._own(task_id, user_id)
+        if row is None:
+            return None
+        row[2] = task_text
+        return row[1]
+
+    async def delete_task(self, task_id, user_id: int):
+        if parse_occurrence(task_id) is not None:
+            return self._modify_occurrence(task_id, user_id, 2, 1)
+        if self._own(task_id, user_id) is None:
+            return None
+        if int(task_id) in self._archive:
+            return self._archive.pop(int(task_id))[1]
+        return self._remove(int(task_id))[1]
+
+    async def add_subscription(self, user_id: int) -> None:
+        self._subscriptions.setdefault(user_id, [None, None])
+
+    async def set_timezone(self, user_id: int, timezone_name: str) -> None:
+        self._subscriptions.setdefault(user_id, [None, None])[0] = timezone_name
+
+    async def set_reminder_minute(self, user_id: int, minute: int) -> None:
+        self._subscriptions.setdefault(user_id, [None, None])[1] = minute
+
+    async def load_subscriptions(self) -> list:
+        return [(user_id, *settings) for user_id, settings in self._subscriptions.items()]
+
+    async def iter_open_tasks_for_users(self, day: int, user_ids: list, batch_size: int = REMINDER_BATCH_SIZE):
+        for user_id in sorted(user_ids):
+            tasks = await self.get_open_tasks(user_id, day)
+            if tasks:
+                yield user_id, tasks
+
+    async def iter_user_tasks(self, user_id: int, batch_size: int = EXPORT_CHUNK_SIZE):
+        rows = sorted(
+            (day, completed, task_id, task_text)
+            for table in (self._tasks, self._archive)
+            for task_id, (owner, day, task_text, completed) in table.items()
+            if owner == user_id
+        )
+        for start in range(0, len(rows), batch_size):
+            yield [(task_id, day, task_text, completed) for day, completed, task_id, task_text in rows[start:start + batch_size]]
+
+    async def archive_tasks(self, cutoff: int, limit: int = ARCHIVE_BATCH_SIZE) -> tuple:
+        ids = [task_id for task_id, row in self._tasks.items() if row[1] < cutoff and row[3]][:limit]
+        days = set()
+        for task_id in ids:
+            row = self._remove(task_id)
+            self._archive[task_id] = row
+            days.add((row[0], row[1]))
+        return len(ids), sorted(days)
+
+    async def vacuum(self, pages: int = ARCHIVE_VACUUM_PAGES) -> int:
+        return 0
+
+    def stats(self) -> dict:
+        return {}
+
+    async def close(self) -> None:
+        pass
+
+
+# SQLite, разбитый по user_id на несколько файлов. Каждый шард - отдельный
+# SQLiteStorage со своим потоком, соединением и очередью записей, поэтому
+# записи разных пользователей фиксируются параллельно, каждая под своей
+# блокировкой. Все данные пользователя лежат в одном шарде.
+class ShardedSQLiteStorage(TaskStorage):
+    def __init__(self, paths: list):
+        for number, path in enumerate(paths):
+            self.check_layout(path, number, len(paths))
+        self.shards = [SQLiteStorage(path) for path in paths]
+
+    @staticmethod
+    def check_layout(path: str, number: int, count: int) -> None:
+        # Файл шарда помнит свой номер и число шардов. При другом PLANNER_SHARDS или
+        # PLANNER_SHARD_PATHS пользователи молча переехали бы на чужие шарды, а их
+        # задачи и подписки пропали бы из вида - такой запуск останавливается
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS shard_layout (shard INTEGER, shards INTEGER)")
+            layout = conn.execute("SELECT shard, shards FROM shard_layout").fetchone()
+            if layout is None:
+                conn.execute("INSERT INTO shard_layout (shard, shards) VALUES (?, ?)", (number, count))
+            elif tuple(layout) != (number, count):
+                raise ValueError(
+                    f"Shard file {path} is shard {layout[0]} of {layout[1]}, but the configuration "
+                    f"uses it as shard {number} of {count}; restore PLANNER_SHARDS / PLANNER_SHARD_PATHS "
+                    f"or migrate the data before changing the shard layout"
+                )
+        finally:
+            conn.close()
+
+    def shard(self, user_id: int) -> SQLiteStorage:
+        # Стабильный хэш: распределение не меняется между перезапусками
+        return self.shards[zlib.crc32(str(user_id).encode()) % len(self.shards)]
+
+    async def add_task(self, user_id: int, day: int, task_text: str) -> int:
+        return await self.shard(user_id).add_task(user_id, day, task_text)
+
+    async def import_tasks(self, user_id: int, rows) -> int:
+        # Генератор строк уходит в поток шарда как есть и разбирается там по мере вставки
+        return await self.shard(user_id).import_tasks(user_id, rows)
+
+    async def get_day_page(self, user_id: int, day: int, after_id: int = 0, limit: int = PAGE_SIZE) -> tuple:
+        return await self.shard(user_id).get_day_page(user_id, day, after_id, limit)
+
+    async def get_day_range(self, user_id: int, start: int, end: int, limit: int = PAGE_SIZE) -> dict:
+        return await self.shard(user_id).get_day_range(user_id, start, end, limit)
+
+    async def search_tasks(self, user_id: int, words: list, offset: int = 0, limit: int = SEARCH_PAGE_SIZE) -> tuple:
+        return await self.shard(user_id).search_tasks(user_id, words, offset, limit)
+
+    async def get_open_tasks(self, user_id: int, day: int) -> list:
+        return await self.shard(user_id).get_open_tasks(user_id, day)
+
+    async def get_task(self, task_id, user_id: int):
+        return await self.shard(user_id).get_task(task_id, user_id)
+
+    async def complete_task(self, task_id, user_id: int):
+        return await self.shard(user_id).complete_task(task_id, user_id)
+
+    async def update_task_text(self, task_id, user_id: int, task_text: str):
+        return await self.shard(user_id).update_task_text(task_id, user_id, task_text)
+
+    async def delete_task(self, task_id, user_id: int):
+        return await self.shard(user_id).delete_task(task_id, user_id)
+
+    async def add_rule(self, user_id: int, kind: str, start: int, end: int, task_text: str) -> int:
+        return await self.shard(user_id).add_rule(user_id, kind, start, end, task_text)
+
+    async def end_rule(self, rule_id: int, user_id: int, day: int) -> bool:
+        return await self.shard(user_id).end_rule(rule_id, user_id, day)
+
+    async def get_occurrences(self, user_ids: list, first: int, last: int) -> dict:
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard(user_id), []).append(user_id)
+        parts = await asyncio.gather(*(shard.get_occurrences(group, first, last) for shard, group in groups.items()))
+        return {key: value for part in parts for key, value in part.items()}
+
+    async def add_subscription(self, user_id: int) -> None:
+        await self.shard(user_id).add_subscription(user_id)
+
+    async def set_timezone(self, user_id: int, timezone_name: str) -> None:
+        await self.shard(user_id).set_timezone(user_id, timezone_name)
+
+    async def set_reminder_minute(self, user_id: int, minute: int) -> None:
+        await self.shard(user_id).set_reminder_minute(user_id, minute)
+
+    async def load_subscriptions(self) -> list:
+        parts = await asyncio.gather(*(shard.load_subscriptions() for shard in self.shards))
+        return [subscription for part in parts for subscription in part]
+
+    async def iter_open_tasks_for_users(self, day: int, user_ids: list, batch_size: int = REMINDER_BATCH_SIZE):
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard(user_id), []).append(user_id)
+        for shard, group in groups.items():
+            async for user_id, tasks in shard.iter_open_tasks_for_users(day, group, batch_size):
+                yield user_id, tasks
+
+    async def iter_user_tasks(self, user_id: int, batch_size: int = EXPORT_CHUNK_SIZE):
+        async for rows in self.shard(user_id).iter_user_tasks(user_id, batch_size):
+            yield rows
+
+    async def archive_tasks(self, cutoff: int, limit: int = ARCHIVE_BATCH_SIZE) -> tuple:
+        results = await asyncio.gather(*(shard.archive_tasks(cutoff, limit) for shard in self.shards))
+        return sum(moved for moved, days in results), [day for moved, days in results for day in days]
+
+    async def vacuum(self, pages: int = ARCHIVE_VACUUM_PAGES) -> int:
+        return sum(await asyncio.gather(*(shard.vacuum(pages) for shard in self.shards)))
+
+    def stats(self) -> dict:
+        parts = [shard.stats() for shard in self.shards]
+        batches = sum(part['batches'] for part in parts)
+        operations = sum(part['operations'] for part in parts)
+        return {
+            'queued': sum(part['queued'] for part in parts),
+            'batches': batches,
+            'operations': operations,
+            'avg_batch': operations / batches if batches else 0.0,
+            'max_batch': max(part['max_batch'] for part in parts),
+            'avg_commit_seconds':
+                sum(part['avg_commit_seconds'] * part['batches'] for part in parts) / batches if batches else 0.0,
+            'max_commit_seconds': max(part['max_commit_seconds'] for part in parts),
+        }
+
+    async def close(self) -> None:
+        for shard in self.shards:
+            await shard.close()
+
+
+def shard_paths(path: str, count: int) -> list:
+    root, extension = os.path.splitext(path)
+    return [f"{root}.{number}{extension}" for number in range(count)]
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> TaskStorage:
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sharded':
+        return ShardedSQLiteStorage(SHARD_PATHS or shard_paths(DB_PATH, SHARDS))
+    if backend != 'sqlite':
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return SQLiteStorage(DB_PATH)
+
+
+storage = create_storage()
+
+
+# Хранение user_data и состояний ConversationHandler в SQLite.
+# У пользователя одна компактная запись (JSON); при сбросе записываются
+# только пользователи, чья запись действительно изменилась, и все они
+# фиксируются общей транзакцией очереди WriteQueue. После перезапуска
+# данные не загружаются целиком: запись пользователя читается при его
+# первом обновлении (refresh_user_data).
+class SQLitePersistence(BasePersistence):
+    def __init__(self, path: str, update_interval: float = STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='planner-state')
+        self.writes = WriteQueue(self._run, self._connection, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY)
+        # Пользователи, чья запись уже прочитана, и хэш последней сохраненной записи
+        self._loaded = set()
+        self._stored = {}
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, factory=TimedConnection)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "name TEXT, key TEXT, state INTEGER, PRIMARY KEY (name, key)) WITHOUT ROWID"
+            )
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        return self._connection().execute(sql, params).fetchall()
+
+    @staticmethod
+    def _store_user(conn: sqlite3.Connection, user_id: int, record) -> None:
+        if record is None:
+            conn.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+        else:
+            conn.execute(
+                "INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data",
+                (user_id, record)
+            )
+
+    @staticmethod
+    def _store_conversation(conn: sqlite3.Connection, name: str, key: str, state) -> None:
+        if state is None:
+            conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+        else:
+            conn.execute(
+                "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET state = excluded.state",
+                (name, key, state)
+            )
+
+    async def get_user_data(self) -> dict:
+        # Ничего не загружаем заранее, см. refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        # Незавершенных диалогов немного, они читаются при запуске
+        rows = await self._run(self._fetchall, "SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        await self.writes.submit(self._store_conversation, name, json.dumps(key), new_state)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded:
+            return
+        rows = await self._run(self._fetchall, "SELECT data FROM user_state WHERE user_id = ?", (user_id,))
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        if rows:
+            for key, value in json.loads(rows[0][0]).items():
+                user_data.setdefault(key, value)
+            self._stored[user_id] = hash(rows[0][0])
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        try:
+            record = json.dumps(data, ensure_ascii=False, separators=(',', ':'), sort_keys=True) if data else None
+        except (TypeError, ValueError) as e:
+            logger.error(f"Cannot persist user_data of user {user_id}: {e}")
+            return
+        digest = hash(record)
+        if self._stored.get(user_id, hash(None)) == digest:
+            return
+        await self.writes.submit(self._store_user, user_id, record)
+        self._stored[user_id] = digest
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.writes.submit(self._store_user, user_id, None)
+        self._stored.pop(user_id, None)
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def flush(self) -> None:
+        await self.writes.close()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+
+# LRU-кэш с ограничением времени жизни для представлений дня.
+# Ключ - (user_id, day), внутри хранятся отрисованные страницы по курсору.
+# Инвалидация сбрасывает все страницы дня и увеличивает версию ключа, поэтому
+# отрисовка, начатая до записи, не сможет положить в кэш устаревший результат.
+class DayViewCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # key -> [версия, момент устаревания, {курсор: представление}]
+        self._entries = OrderedDict()
+
+    def lookup(self, key: tuple, page: int = 0):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, 0
+        version, expires_at, pages = entry
+        if pages is None or page not in pages or expires_at < clock.monotonic():
+            self.misses += 1
+            return None, version
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return pages[page], version
+
+    def version(self, key: tuple) -> int:
+        # Версия без учета в статистике попаданий: для заполнения кэша заранее
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else 0
+
+    def put(self, key: tuple, page: int, view, version: int) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] != version:
+            # Пока шла выборка, день был изменен
+            return
+        if entry is None or entry[2] is None or entry[1] < clock.monotonic():
+            entry = [version, clock.monotonic() + self.ttl, {}]
+            self._entries[key] = entry
+        entry[2][page] = view
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def invalidate(self, key: tuple) -> None:
+        self.invalidations += 1
+        entry = self._entries.get(key)
+        version = entry[0] + 1 if entry is not None else 1
+        self._entries[key] = [version, 0, None]
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def invalidate_user(self, user_id: int) -> None:
+        # Все закэшированные дни пользователя, например после нового правила повторения
+        for key in [key for key in self._entries if key[0] == user_id]:
+            self.invalidate(key)
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+day_cache = DayViewCache(DAY_CACHE_SIZE, DAY_CACHE_TTL)
+
+
+@lru_cache(maxsize=None)
+def get_zone(timezone_name: str):
+    try:
+        return ZoneInfo(timezone_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+# UTC-минута суток, на которую в указанный день приходится местное время напоминания
+@lru_cache(maxsize=4096)
+def utc_bucket(timezone_name: str, minute: int, day) -> int:
+    local = datetime.combine(day, time(minute // 60, minute % 60), tzinfo=get_zone(timezone_name))
+    moment = local.astimezone(timezone.utc)
+    return moment.hour * 60 + moment.minute
+
+
+# Колесо напоминаний: подписчики разложены по минутным UTC-бакетам.
+# Планировщик раз в минуту забирает один бакет, поэтому нагрузка распределена
+# по суткам, а в JobQueue живет одна задача вместо задачи на пользователя.
+# Раз в сутки бакеты пересчитываются с учетом перехода на летнее время.
+class ReminderWheel:
+    SIZE = 24 * 60
+
+    def __init__(self):
+        self._buckets = [set() for _ in range(self.SIZE)]
+        # user_id -> (часовой пояс, минута напоминания, бакет)
+        self._users = {}
+        self._day = None
+        self._last_bucket = None
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _today(self):
+        return self._day or datetime.now(timezone.utc).date()
+
+    def add(self, user_id: int, timezone_name: str = None, minute: int = None) -> None:
+        old = self._users.get(user_id)
+        if old is not None:
+            self._buckets[old[2]].discard(user_id)
+            timezone_name = timezone_name or old[0]
+            minute = old[1] if minute is None else minute
+        timezone_name = timezone_name or DEFAULT_TIMEZONE
+        minute = DEFAULT_REMINDER_MINUTE if minute is None else minute
+        bucket = utc_bucket(timezone_name, minute, self._today())
+        self._users[user_id] = (timezone_name, minute, bucket)
+        self._buckets[bucket].add(user_id)
+
+    def load(self, subscriptions) -> None:
+        for user_id, timezone_name, minute in subscriptions:
+            self.add(user_id, timezone_name, minute)
+
+    def settings(self, user_id: int) -> tuple:
+        timezone_name, minute, bucket = self._users[user_id]
+        return timezone_name, minute
+
+    def _rebuild(self) -> None:
+        for bucket in self._buckets:
+            bucket.clear()
+        for user_id, (timezone_name, minute, old_bucket) in self._users.items():
+            bucket = utc_bucket(timezone_name, minute, self._day)
+            self._users[user_id] = (timezone_name, minute, bucket)
+            self._buckets[bucket].add(user_id)
+
+    def advance(self, now: datetime) -> dict:
+        # Возвращает подписчиков всех бакетов, наступивших с прошлого вызова,
+        # сгруппированных по часовому поясу
+        current = now.hour * 60 + now.minute
+        due = {}
+        if self._day != now.date():
+            if self._last_bucket is not None:
+                # Досылаем бакеты прошлых суток, пропущенные из-за задержки
+                self._collect(due, self._last_bucket + 1, self.SIZE)
+            self._day = now.date()
+            self._rebuild()
+            self._last_bucket = -1 if self._last_bucket is not None else current - 1
+        self._collect(due, self._last_bucket + 1, current + 1)
+        self._last_bucket = current
+        return due
+
+    def _collect(self, due: dict, first: int, last: int) -> None:
+        for bucket in self._buckets[first:last]:
+            for user_id in bucket:
+                due.setdefault(self._users[user_id][0], []).append(user_id)
+
+
+# Подписчики на ежедневные напоминания.
+# Копия таблицы subscriptions, загружается при старте бота.
+reminder_wheel = ReminderWheel()
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+# Приоритеты исходящих запросов: ответы пользователям уходят раньше рассылки
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk'}
+
+
+# Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+# blocked_until - пауза после ответа 429.
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        # Через сколько секунд можно взять токен
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+# Единая очередь исходящих запросов к Bot API.
+# Подключается к ExtBot как rate limiter, поэтому через нее проходят все
+# reply_text, edit_message_text и send_message. Запросы с chat_id ждут
+# токен общей корзины и корзины своего чата; ожидающие выстроены в куче по
+# (приоритет, порядок поступления), и чат без токенов не задерживает другие.
+# При ответе 429 запрос повторяется после retry_after, паузы растут с каждой
+# попыткой. Запросы без чата (answerCallbackQuery, getMe) идут сразу.
+class OutboundQueue(BaseRateLimiter):
+    def __init__(self, rate: float, chat_rate: float, chat_burst: int, group_rate: float,
+                 retries: int, backoff: float):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.retries = retries
+        self.backoff = backoff
+        self._global = None
+        self._chats = {}
+        self._prune_at = OUTBOUND_CHAT_BUCKETS
+        # (приоритет, номер, chat_id, future)
+        self._heap = []
+        self._order = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def initialize(self) -> None:
+        # Application и Updater оба инициализируют бота, а с ним и очередь
+        if self._dispatcher is not None:
+            return
+        self._global = TokenBucket(self.rate, self.rate, clock.monotonic())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, _, future in self._heap:
+            future.cancel()
+        self._heap.clear()
+
+    def _bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._prune_at:
+                # Корзины простаивающих чатов полны и ничего не ограничивают
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle(now)}
+                self._prune_at = max(OUTBOUND_CHAT_BUCKETS, 2 * len(self._chats))
+            # Группы и каналы имеют отрицательный id или @username
+            group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst, now)
+        return bucket
+
+    def _grant(self):
+        # Выдает токены всем, кому можно; возвращает время до следующей
+        # возможной выдачи или None, если очередь пуста
+        now = clock.monotonic()
+        deferred = []
+        wait = None
+        while self._heap:
+            delay = self._global.delay(now)
+            if delay > 0:
+                wait = delay
+                break
+            entry = heapq.heappop(self._heap)
+            future = entry[3]
+            if future.done():
+                continue
+            bucket = self._bucket(entry[2], now)
+            delay = bucket.delay(now)
+            if delay > 0:
+                deferred.append(entry)
+                continue
+            self._global.take()
+            bucket.take()
+            future.set_result(None)
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+            delay = self._chats[entry[2]].delay(now)
+            wait = delay if wait is None else min(wait, delay)
+        return wait
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            wait = self._grant()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, chat_id, priority: int) -> None:
+        started = clock.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._order), chat_id, future))
+        self._wakeup.set()
+        await future
+        if metrics.enabled:
+            metrics.observe('outbound_wait_seconds', 'priority', PRIORITY_NAMES.get(priority, priority),
+                            clock.monotonic() - started)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        for attempt in range(self.retries + 1):
+            if chat_id is not None:
+                await self._acquire(chat_id, priority)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.retries:
+                    logger.error(f"Giving up on {endpoint} for {chat_id} after {attempt + 1} attempts")
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                delay = max(retry_after_seconds(e), self.backoff * 2 ** attempt)
+                if chat_id is None:
+                    await asyncio.sleep(delay)
+                else:
+                    bucket = self._bucket(chat_id, clock.monotonic())
+                    bucket.blocked_until = max(bucket.blocked_until, clock.monotonic() + delay)
+
+    def stats(self) -> dict:
+        queued = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, future in self._heap:
+            if not future.done():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                queued[name] = queued.get(name, 0) + 1
+        stats = {f"queued_{name}": count for name, count in queued.items()}
+        stats.update({
+            'queued': sum(queued.values()),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'chats': len(self._chats),
+        })
+        return stats
+
+
+outbound = OutboundQueue(
+    OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE,
+    OUTBOUND_RETRIES, OUTBOUND_BACKOFF
+)
+
+
+# Массовая рассылка с ограничением числа одновременных запросов.
+# Скоростью и повторами после 429 занимается очередь OutboundQueue,
+# сообщения рассылки идут в ней с низким приоритетом.
+class ReminderSender:
+    def __init__(self, bot, concurrency: int):
+        self.bot = bot
+        self.sent = 0
+        self.failed = 0
+        self._options = {'rate_limit_args': PRIORITY_BULK} if getattr(bot, 'rate_limiter', None) else {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    async def _deliver(self, chat_id: int, text: str) -> None:
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, **self._options)
+            self.sent += 1
+        except Exception as e:
+            logger.error(f"Error sending reminder to {chat_id}: {e}")
+            self.failed += 1
+        finally:
+            self._semaphore.release()
+
+    async def send(self, chat_id: int, text: str) -> None:
+        # Ожидание семафора не дает выборке убегать вперед отправки
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._deliver(chat_id, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def join(self) -> None:
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+
+def format_reminder(tasks: list) -> str:
+    if tasks:
+        tasks_text = "\n".join([f"• {task}" for task in tasks])
+        return f"🌞 Доброе утро! Вот твои задачи на сегодня:\n\n{tasks_text}"
+    return "🌞 Доброе утро! На сегодня задач нет, отличный день для отдыха!"
+
+
+# Номера дней. В базе и в callback_data день - целое date.toordinal(),
+# соседние дни получаются сложением, а разбор и форматирование текста
+# кэшируются: в работе бота встречается лишь небольшой набор дат.
+DAY_FORMAT = "%Y-%m-%d"
+
+
+@lru_cache(maxsize=4096)
+def parse_day(text: str) -> int:
+    # ValueError для неверной даты; исключения не кэшируются
+    return datetime.strptime(text, DAY_FORMAT).toordinal()
+
+
+@lru_cache(maxsize=4096)
+def format_day(day: int) -> str:
+    return datetime.fromordinal(day).strftime(DAY_FORMAT)
+
+
+def today() -> int:
+    return datetime.now().toordinal()
+
+
+def callback_day(value: str) -> int:
+    # Кнопки из старых сообщений содержат дату текстом
+    return parse_day(value) if '-' in value else int(value)
+
+
+# Отрисовка страницы списка задач на день: (текст, клавиатура, есть ли задачи).
+# page - курсор страницы: id последней задачи предыдущей страницы (0 - первая).
+# Повторения правил показываются в начале первой страницы.
+async def render_day(user_id: int, day: int, page: int = 0) -> tuple:
+    key = (user_id, day)
+    view, version = day_cache.lookup(key, page)
+    if view is not None:
+        return view
+
+    tasks, has_next, prev_cursor = await storage.get_day_page(user_id, day, page)
+    if not page:
+        occurrences = await storage.get_occurrences([user_id], day, day)
+        tasks = occurrences.get(key, []) + tasks
+    started = clock.perf_counter()
+
+    view = build_day_view(day, tasks, has_next, prev_cursor)
+    day_cache.put(key, page, view, version)
+    if metrics.enabled:
+        metrics.observe('render_seconds', 'view', 'day', clock.perf_counter() - started)
+    return view
+
+
+def build_day_view(day: int, tasks: list, has_next: bool, prev_cursor) -> tuple:
+    keyboard = []
+    lines = [f"📝 Задачи на {format_day(day)}:\n"]
+
+    for task_id, task_text, completed in tasks:
+        status = "✅" if completed else "🟩"
+        if len(task_text) > TASK_LINE_LIMIT:
+            task_text = task_text[:TASK_LINE_LIMIT] + "…"
+        # Повторения правил отмечаются значком вместо номера; в тексте списка
+        # рядом с ним id повторения, который можно ввести в /edit и /delete
+        label = "🔁" if isinstance(task_id, str) else f"{task_id}."
+        line_label = f"{label} {task_id}" if isinstance(task_id, str) else label
+        lines.append(f"{line_label} [{status}] {task_text}")
+
+        # Создаем кнопки для каждой задачи
+        keyboard.append([
+            InlineKeyboardButton(f"{label} {task_text[:15]}...", callback_data=f"view_{task_id}")
+        ])
+
+    # Листание страниц
+    pages_row = []
+    if prev_cursor is not None:
+        pages_row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"page_{day}_{prev_cursor}"))
+    if has_next:
+        pages_row.append(InlineKeyboardButton("Далее ➡️", callback_data=f"page_{day}_{tasks[-1][0]}"))
+    if pages_row:
+        keyboard.append(pages_row)
+
+    # Кнопки управления
+    keyboard.append([
+        InlineKeyboardButton("◀️ Пред. день", callback_data=f"prev_{day - 1}"),
+        InlineKeyboardButton("▶️ След. день", callback_data=f"next_{day + 1}")
+    ])
+
+    return "\n".join(lines) + "\n", InlineKeyboardMarkup(keyboard), bool(tasks)
+
+
+# Обзор недели или месяца: один запрос на весь диапазон.
+# Первые страницы всех дней сразу кладутся в кэш, поэтому
+# переход к дню из обзора обходится без обращения к базе.
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+
+def week_bounds(day: int) -> tuple:
+    # День 1 (0001-01-01) - понедельник
+    start = day - (day - 1) % 7
+    return start, start + 6
+
+
+@lru_cache(maxsize=1024)
+def month_bounds(day: int) -> tuple:
+    start = datetime.fromordinal(day).replace(day=1)
+    next_month = (start + timedelta(days=32)).replace(day=1)
+    return start.toordinal(), next_month.toordinal() - 1
+
+
+async def render_range(user_id: int, kind: str, day: int) -> tuple:
+    start, end = week_bounds(day) if kind == 'week' else month_bounds(day)
+    days = range(start, end + 1)
+
+    # Версии берутся до запроса, чтобы не закэшировать день, измененный во время выборки
+    versions = [day_cache.version((user_id, current)) for current in days]
+    summary = await storage.get_day_range(user_id, start, end)
+    occurrences = await storage.get_occurrences([user_id], start, end)
+    started = clock.perf_counter()
+
+    total_open = total_done = 0
+    lines = []
+    buttons = []
+    for current, version in zip(days, versions):
+        tasks, open_count, done_count = summary.get(current, ([], 0, 0))
+        repeated = occurrences.get((user_id, current), [])
+        repeated_done = sum(1 for occurrence in repeated if occurrence[2])
+        open_count += len(repeated) - repeated_done
+        done_count += repeated_done
+        total_open += open_count
+        total_done += done_count
+        day_cache.put(
+            (user_id, current), 0,
+            build_day_view(current, repeated + tasks[:PAGE_SIZE], len(tasks) > PAGE_SIZE, None), version
+        )
+        tasks = repeated + tasks
+
+        text = format_day(current)
+        label = f"{WEEKDAYS[(current - 1) % 7]} {text[8:]}.{text[5:7]}"
+        if tasks:
+            lines.append(f"{label}: 🟩 {open_count} ✅ {done_count}")
+        elif kind == 'week':
+            lines.append(f"{label}: —")
+        if kind == 'week':
+            buttons.append([InlineKeyboardButton(f"{label} · {open_count}/{done_count}", callback_data=f"day_{current}")])
+        else:
+            buttons.append(InlineKeyboardButton(f"{int(text[8:])}{'•' if tasks else ''}", callback_data=f"day_{current}"))
+
+    if kind == 'week':
+        title = f"📅 Неделя {format_day(start)} — {format_day(end)}"
+        keyboard = buttons
+        keyboard.append([
+            InlineKeyboardButton("◀️ Пред. неделя", callback_data=f"week_{start - 7}"),
+            InlineKeyboardButton("▶️ След. неделя", callback_data=f"week_{start + 7}")
+        ])
+    else:
+        title = f"📅 {format_day(start)[:7]}"
+        keyboard = [buttons[offset:offset + 7] for offset in range(0, len(buttons), 7)]
+        keyboard.append([
+            InlineKeyboardButton("◀️ Пред. месяц", callback_data=f"month_{start - 1}"),
+            InlineKeyboardButton("▶️ След. месяц", callback_data=f"month_{end + 1}")
+        ])
+        if not lines:
+            lines.append("Задач нет")
+
+    text = f"{title}\n\n" + "\n".join(lines) + f"\n\nВсего: 🟩 {total_open} ✅ {total_done}"
+    if metrics.enabled:
+        metrics.observe('render_seconds', 'view', kind, clock.perf_counter() - started)
+    return text, InlineKeyboardMarkup(keyboard)
 
 
 # Команда /start
@@ -52,70 +2338,363 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         user = update.message.from_user
 
-        # Улучшенная проверка доступности job_queue
-        if hasattr(context, 'job_queue') and context.job_queue is not None:
-            # Проверяем наличие существующей задачи
-            job_exists = any(job.name == str(user.id) for job in context.job_queue.jobs())
-
-            if not job_exists:
-                context.job_queue.run_daily(
-                    send_daily_reminder,
-                    time(hour=7, minute=0, second=0, tzinfo=None),
-                    context=user.id,
-                    name=str(user.id)
-                )
-                logger.info(f"Added daily reminder for user {user.id}")
-        else:
-            logger.warning("Job queue is not available - reminders disabled")
+        # Напоминания рассылает одна общая задача, здесь только подписка
+        if user.id not in reminder_wheel:
+            await storage.add_subscription(user.id)
+            reminder_wheel.add(user.id)
+            logger.info(f"Added daily reminder for user {user.id}")
+        timezone_name, minute = reminder_wheel.settings(user.id)
 
         await update.message.reply_text(
             "📅 Привет! Я твой умный планировщик задач.\n\n"
             "Доступные команды:\n"
-            "/add - Добавить задачу\n"
+            "/add - Добавить задачу (или несколько: по строке «ГГГГ-ММ-ДД описание»)\n"
             "/list - Показать задачи\n"
+            "/week - Обзор недели\n"
+            "/month - Обзор месяца\n"
+            "/search - Поиск задач по тексту\n"
+            "/repeat - Повторяющаяся задача\n"
             "/edit - Редактировать задачу\n"
             "/delete - Удалить задачу\n"
             "/done - Отметить выполненной\n"
-            "\nЯ буду присылать тебе ежедневные напоминания в 7:00 утра!"
+            "/timezone - Часовой пояс\n"
+            "/remind - Время напоминания\n"
+            "/export - Выгрузить все задачи (csv или json)\n"
+            "📎 Пришлите CSV или ICS файл, чтобы импортировать задачи\n"
+            f"\nЯ буду присылать тебе ежедневные напоминания в {minute // 60}:{minute % 60:02d} "
+            f"({timezone_name})!"
         )
     except Exception as e:
         logger.error(f"Error in start command: {e}")
         await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
 
 
-# Отправка ежедневного напоминания
+# Рассылка напоминаний пользователям, сгруппированным по часовому поясу
+async def dispatch_reminders(bot, due: dict, now: datetime) -> None:
+    started = clock.monotonic()
+    sender = ReminderSender(bot, REMINDER_CONCURRENCY)
+    total = 0
+    for timezone_name, user_ids in due.items():
+        total += len(user_ids)
+        day = now.astimezone(get_zone(timezone_name)).toordinal()
+
+        # Открытые повторения на сегодня, правила всех пользователей пояса разом
+        repeated = {}
+        for (user_id, _), occurrences in (await storage.get_occurrences(user_ids, day, day)).items():
+            repeated[user_id] = [task_text for _, task_text, completed in occurrences if not completed]
+
+        # Открытые задачи всех пользователей пояса приходят пакетными выборками
+        notified = set()
+        async for user_id, tasks in storage.iter_open_tasks_for_users(day, user_ids):
+            notified.add(user_id)
+            await sender.send(user_id, format_reminder(repeated.get(user_id, []) + tasks))
+
+        for user_id in user_ids:
+            if user_id not in notified:
+                await sender.send(user_id, format_reminder(repeated.get(user_id, [])))
+
+    await sender.join()
+    logger.info(
+        f"Daily reminders for {total} users: {sender.sent} sent, "
+        f"{sender.failed} failed in {clock.monotonic() - started:.2f}s"
+    )
+
+
+# Отправка ежедневных напоминаний.
+# Вызывается раз в минуту и обслуживает наступившие бакеты колеса.
 async def send_daily_reminder(context: ContextTypes.DEFAULT_TYPE):
     try:
-        user_id = context.job.context
-        today = datetime.now().strftime("%Y-%m-%d")
+        now = datetime.now(timezone.utc)
+        due = reminder_wheel.advance(now)
+        if due:
+            await dispatch_reminders(context.bot, due, now)
+    except Exception as e:
+        logger.error(f"Error sending daily reminder: {e}")
 
-        conn = sqlite3.connect('planner.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT task FROM tasks WHERE user_id = ? AND date = ? AND completed = 0",
-            (user_id, today)
-        )
-        tasks = cursor.fetchall()
-        conn.close()
 
-        if tasks:
-            tasks_text = "\n".join([f"• {task[0]}" for task in tasks])
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"🌞 Доброе утро! Вот твои задачи на сегодня:\n\n{tasks_text}"
-            )
+# Фоновое архивирование: выполненные задачи старше ARCHIVE_AFTER_DAYS
+# переносятся в архив небольшими пачками, между пачками успевают
+# пройти записи пользователей. Затем освобождается часть свободных страниц.
+async def archive_tasks(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        cutoff = today() - ARCHIVE_AFTER_DAYS
+        archived = 0
+        while True:
+            moved, days = await storage.archive_tasks(cutoff)
+            for user_id, day in days:
+                day_cache.invalidate((user_id, day))
+            archived += moved
+            if moved < ARCHIVE_BATCH_SIZE:
+                break
+        freed = await storage.vacuum()
+        if archived or freed:
+            logger.info(f"Archival before {format_day(cutoff)}: {archived} tasks moved, {freed} pages released")
+    except Exception as e:
+        logger.error(f"Error in archive_tasks: {e}")
+
+
+# Команда /timezone: установка часового пояса
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user_id = update.message.from_user.id
+        if not context.args:
+            await update.message.reply_text("🌍 Укажите часовой пояс, например: /timezone Europe/Moscow")
+            return
+
+        timezone_name = context.args[0]
+        try:
+            ZoneInfo(timezone_name)
+        except (ZoneInfoNotFoundError, ValueError):
+            await update.message.reply_text("❌ Неизвестный часовой пояс! Пример: Europe/Moscow")
+            return
+
+        await storage.set_timezone(user_id, timezone_name)
+        reminder_wheel.add(user_id, timezone_name=timezone_name)
+        await update.message.reply_text(f"✅ Часовой пояс установлен: {timezone_name}")
+    except Exception as e:
+        logger.error(f"Error in set_timezone: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
+
+
+# Команда /remind: установка времени напоминания
+async def set_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user_id = update.message.from_user.id
+        try:
+            moment = datetime.strptime(context.args[0], "%H:%M")
+        except (IndexError, ValueError):
+            await update.message.reply_text("⏰ Укажите время в формате ЧЧ:ММ, например: /remind 08:30")
+            return
+
+        minute = moment.hour * 60 + moment.minute
+        await storage.set_reminder_minute(user_id, minute)
+        reminder_wheel.add(user_id, minute=minute)
+        await update.message.reply_text(f"✅ Напоминание будет приходить в {moment.strftime('%H:%M')}")
+    except Exception as e:
+        logger.error(f"Error in set_reminder_time: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
+
+
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+# Проверка строк импорта: из записей (номер строки, дата, текст, выполнена)
+# получаются строки для вставки, ошибки копятся с номерами строк
+class TaskImport:
+    def __init__(self):
+        self.days = set()
+        self.errors = []
+        self.error_count = 0
+
+    def _error(self, line_no: int, message: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < IMPORT_REPORTED_ERRORS:
+            self.errors.append(f"строка {line_no}: {message}")
+
+    def rows(self, records):
+        for line_no, date_str, task_text, completed in records:
+            if not DATE_PATTERN.fullmatch(date_str or ''):
+                self._error(line_no, "неверная дата")
+                continue
+            try:
+                day = parse_day(date_str)
+            except ValueError:
+                self._error(line_no, "неверная дата")
+                continue
+            task_text = (task_text or '').strip()
+            if not task_text:
+                self._error(line_no, "пустое описание")
+                continue
+            if len(task_text) > IMPORT_MAX_TASK_LENGTH:
+                self._error(line_no, "слишком длинное описание")
+                continue
+            self.days.add(day)
+            yield day, task_text, completed
+
+    def report(self, inserted: int) -> str:
+        response = f"✅ Импортировано задач: {inserted}"
+        if self.error_count:
+            response += f"\n\n⚠️ Пропущено строк: {self.error_count}\n" + "\n".join(self.errors)
+            if self.error_count > len(self.errors):
+                response += f"\n…и еще {self.error_count - len(self.errors)}"
+        return response
+
+
+# Строки вида "ГГГГ-ММ-ДД описание"
+def parse_text_lines(lines, first_line_no: int = 1):
+    for line_no, line in enumerate(lines, start=first_line_no):
+        line = line.strip()
+        if not line:
+            continue
+        date_str, _, task_text = line.partition(' ')
+        yield line_no, date_str, task_text, 0
+
+
+# CSV: дата, описание[, выполнена]; строка заголовка пропускается
+def parse_csv(stream):
+    sample = stream.read(4096)
+    stream.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    for line_no, row in enumerate(csv.reader(stream, dialect), start=1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if line_no == 1 and row[0].strip().lower() in ('date', 'дата'):
+            continue
+        completed = row[2].strip().lower() in ('1', 'true', 'yes', 'да', 'x') if len(row) > 2 else False
+        yield line_no, row[0].strip(), row[1] if len(row) > 1 else '', int(completed)
+
+
+# ICS: каждое событие VEVENT становится задачей на дату DTSTART с текстом SUMMARY
+def parse_ics(stream):
+    event = None
+    line_no, pending, pending_no = 0, None, 0
+
+    def unfolded():
+        # Перенесенные строки iCalendar начинаются с пробела или табуляции
+        nonlocal line_no, pending, pending_no
+        for raw in stream:
+            line_no += 1
+            raw = raw.rstrip('\r\n')
+            if raw[:1] in (' ', '\t') and pending is not None:
+                pending += raw[1:]
+                continue
+            if pending is not None:
+                yield pending_no, pending
+            pending, pending_no = raw, line_no
+        if pending is not None:
+            yield pending_no, pending
+
+    for number, line in unfolded():
+        name, _, value = line.partition(':')
+        name = name.split(';', 1)[0].upper()
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {'line': number, 'date': '', 'summary': '', 'completed': 0}
+        elif event is None:
+            continue
+        elif name == 'DTSTART':
+            day = value[:8]
+            event['date'] = f"{day[:4]}-{day[4:6]}-{day[6:8]}" if day.isdigit() else value
+        elif name == 'SUMMARY':
+            event['summary'] = value.replace('\\n', ' ').replace('\\,', ',').replace('\\;', ';')
+        elif name == 'STATUS':
+            event['completed'] = int(value.upper() == 'COMPLETED')
+        elif name == 'END' and value.upper() == 'VEVENT':
+            yield event['line'], event['date'], event['summary'], event['completed']
+            event = None
+
+
+def read_document(path: str, kind: str):
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        if kind == 'ics':
+            yield from parse_ics(stream)
         else:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="🌞 Доброе утро! На сегодня задач нет, отличный день для отдыха!"
+            yield from parse_csv(stream)
+
+
+async def run_import(user_id: int, records) -> str:
+    task_import = TaskImport()
+    inserted = await storage.import_tasks(user_id, task_import.rows(records))
+    for day in task_import.days:
+        day_cache.invalidate((user_id, day))
+    logger.info(f"Imported {inserted} tasks for user {user_id} ({task_import.error_count} rejected)")
+    return task_import.report(inserted)
+
+
+# Импорт задач из присланного CSV или ICS файла
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    path = None
+    try:
+        document = update.message.document
+        user_id = update.message.from_user.id
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await update.message.reply_text("❌ Файл слишком большой для импорта.")
+            return
+
+        kind = 'ics' if (document.file_name or '').lower().endswith('.ics') else 'csv'
+        handle, path = tempfile.mkstemp(suffix=f'.{kind}')
+        os.close(handle)
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+
+        await update.message.reply_text(await run_import(user_id, read_document(path, kind)))
+    except Exception as e:
+        logger.error(f"Error in import_document: {e}")
+        await update.message.reply_text("❌ Ошибка при импорте задач.")
+    finally:
+        if path is not None:
+            os.remove(path)
+
+
+def write_export_chunk(stream, rows: list, export_format: str) -> None:
+    if export_format == 'json':
+        for task_id, day, task_text, completed in rows:
+            stream.write(json.dumps(
+                {'id': task_id, 'date': format_day(day), 'task': task_text, 'completed': bool(completed)},
+                ensure_ascii=False
+            ) + "\n")
+    else:
+        writer = csv.writer(stream)
+        writer.writerows(
+            (format_day(day), task_text, completed, task_id) for task_id, day, task_text, completed in rows
+        )
+
+
+# Команда /export [csv|json]: выгрузка всех задач пользователя файлом.
+# Задачи читаются порциями и сразу дописываются во временный файл,
+# поэтому расход памяти не зависит от размера истории.
+async def export_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    path = None
+    try:
+        user_id = update.message.from_user.id
+        export_format = context.args[0].lower() if context.args else 'csv'
+        if export_format not in ('csv', 'json'):
+            await update.message.reply_text("❌ Формат выгрузки: /export csv или /export json")
+            return
+
+        extension = 'jsonl' if export_format == 'json' else 'csv'
+        handle, path = tempfile.mkstemp(suffix=f'.{extension}')
+        exported = 0
+        with os.fdopen(handle, 'w', encoding='utf-8', newline='') as stream:
+            if export_format == 'csv':
+                stream.write("date,task,completed,id\r\n")
+            async for rows in storage.iter_user_tasks(user_id):
+                await asyncio.to_thread(write_export_chunk, stream, rows, export_format)
+                exported += len(rows)
+
+        if not exported:
+            await update.message.reply_text("🤷‍♂️ Задач для выгрузки нет!")
+            return
+
+        with open(path, 'rb') as document:
+            await update.message.reply_document(
+                document=document,
+                filename=f"tasks.{extension}",
+                caption=f"📦 Выгружено задач: {exported}"
             )
+        logger.info(f"Exported {exported} tasks for user {user_id}")
     except Exception as e:
-        logger.error(f"Error sending daily reminder: {e}")
+        logger.error(f"Error in export_tasks: {e}")
+        await update.message.reply_text("❌ Ошибка при выгрузке задач.")
+    finally:
+        if path is not None:
+            os.remove(path)
 
 
 # Добавление задачи
 async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
+        # Задачи в теле команды: /add и далее по строке "ГГГГ-ММ-ДД описание"
+        command, _, body = update.message.text.partition('\n')
+        first_line = command.split(maxsplit=1)[1:]
+        if first_line or body.strip():
+            lines = first_line + body.split('\n')
+            records = parse_text_lines(lines, first_line_no=1 if first_line else 2)
+            await update.message.reply_text(await run_import(update.message.from_user.id, records))
+            return ConversationHandler.END
+
         await update.message.reply_text("📅 Введите дату в формате ГГГГ-ММ-ДД:")
         return DATE
     except Exception as e:
@@ -125,9 +2704,7 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def get_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
-        date_str = update.message.text
-        datetime.strptime(date_str, "%Y-%m-%d")
-        context.user_data['date'] = date_str
+        context.user_data['day'] = parse_day(update.message.text)
         await update.message.reply_text("✏️ Введите описание задачи:")
         return TASK
     except ValueError:
@@ -142,18 +2719,12 @@ async def get_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         task_text = update.message.text
         user_id = update.message.from_user.id
-        date = context.user_data['date']
+        day = context.user_data['day']
 
-        conn = sqlite3.connect('planner.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO tasks (user_id, date, task) VALUES (?, ?, ?)",
-            (user_id, date, task_text)
-        )
-        conn.commit()
-        conn.close()
+        await storage.add_task(user_id, day, task_text)
+        day_cache.invalidate((user_id, day))
 
-        await update.message.reply_text(f"✅ Задача добавлена на {date}!")
+        await update.message.reply_text(f"✅ Задача добавлена на {format_day(day)}!")
         return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error in get_task: {e}")
@@ -165,54 +2736,300 @@ async def get_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         args = context.args
-        if args and len(args) > 0:
-            date = args[0]
-        else:
-            date = datetime.now().strftime("%Y-%m-%d")
+        try:
+            day = parse_day(args[0]) if args else today()
+        except ValueError:
+            await update.message.reply_text("❌ Неверный формат даты! Используйте ГГГГ-ММ-ДД")
+            return
 
         user_id = update.message.from_user.id
 
-        conn = sqlite3.connect('planner.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, task, completed FROM tasks WHERE user_id = ? AND date = ?",
-            (user_id, date)
-        )
-        tasks = cursor.fetchall()
-        conn.close()
+        response, reply_markup, has_tasks = await render_day(user_id, day)
 
-        if not tasks:
-            await update.message.reply_text(f"🤷‍♂️ На {date} задач нет!")
+        if not has_tasks:
+            await update.message.reply_text(f"🤷‍♂️ На {format_day(day)} задач нет!")
             return
 
-        keyboard = []
-        response = f"📝 Задачи на {date}:\n\n"
+        await update.message.reply_text(response, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error in list_tasks: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка при получении задач.")
+
 
-        for task_id, task_text, completed in tasks:
-            status = "✅" if completed else "🟩"
-            response += f"{task_id}. [{status}] {task_text}\n"
+# Поиск по тексту задач: страница результатов в порядке релевантности
+SEARCH_WORD = re.compile(r"\w+")
 
-            # Создаем кнопки для каждой задачи
-            keyboard.append([
-                InlineKeyboardButton(f"{task_id}. {task_text[:15]}...", callback_data=f"view_{task_id}")
-            ])
 
-        # Кнопки управления
-        prev_date = (datetime.strptime(date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-        next_date = (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+async def render_search(user_id: int, words: list, page: int = 0) -> tuple:
+    tasks, has_next = await storage.search_tasks(user_id, words, page * SEARCH_PAGE_SIZE)
 
+    keyboard = []
+    lines = [f"🔎 Поиск: {' '.join(words)}\n"]
+    for task_id, day, task_text, completed in tasks:
+        status = "✅" if completed else "🟩"
+        if len(task_text) > TASK_LINE_LIMIT:
+            task_text = task_text[:TASK_LINE_LIMIT] + "…"
+        lines.append(f"{task_id}. [{status}] {format_day(day)} {task_text}")
         keyboard.append([
-            InlineKeyboardButton("◀️ Пред. день", callback_data=f"prev_{prev_date}"),
-            InlineKeyboardButton("▶️ След. день", callback_data=f"next_{next_date}")
+            InlineKeyboardButton(f"{task_id}. {task_text[:15]}...", callback_data=f"view_{task_id}")
         ])
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    pages_row = []
+    if page > 0:
+        pages_row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search_{page - 1}"))
+    if has_next:
+        pages_row.append(InlineKeyboardButton("Далее ➡️", callback_data=f"search_{page + 1}"))
+    if pages_row:
+        keyboard.append(pages_row)
+
+    return "\n".join(lines) + "\n", InlineKeyboardMarkup(keyboard), bool(tasks)
+
+
+# Команда /search <слова>
+async def search_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        words = SEARCH_WORD.findall(" ".join(context.args or []))
+        if not words:
+            await update.message.reply_text("🔎 Укажите слова для поиска: /search молоко")
+            return
+
+        # Запрос запоминается для листания страниц кнопками
+        context.user_data['search'] = words
+        response, reply_markup, has_tasks = await render_search(update.message.from_user.id, words)
+
+        if not has_tasks:
+            await update.message.reply_text(f"🤷‍♂️ По запросу «{' '.join(words)}» ничего не найдено!")
+            return
+
         await update.message.reply_text(response, reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error in list_tasks: {e}")
+        logger.error(f"Error in search_tasks: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка при поиске задач.")
+
+
+# Команда /repeat daily|weekdays|weekly|monthly ГГГГ-ММ-ДД [ГГГГ-ММ-ДД] описание:
+# правило с первым и, если указан, последним днем повторения
+REPEAT_USAGE = (
+    "🔁 Формат: /repeat daily|weekdays|weekly|monthly ГГГГ-ММ-ДД [ГГГГ-ММ-ДД] описание\n"
+    "Например: /repeat weekdays 2025-01-13 Зарядка"
+)
+
+
+async def repeat_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        args = context.args
+        if len(args) < 3 or args[0] not in RULE_KINDS:
+            await update.message.reply_text(REPEAT_USAGE)
+            return
+        kind, words = args[0], args[2:]
+        try:
+            start = parse_day(args[1])
+            end = MAX_DAY
+            if DATE_PATTERN.fullmatch(words[0]):
+                end, words = parse_day(words[0]), words[1:]
+        except ValueError:
+            await update.message.reply_text("❌ Неверный формат даты! Используйте ГГГГ-ММ-ДД")
+            return
+        if not words or end < start:
+            await update.message.reply_text(REPEAT_USAGE)
+            return
+
+        user_id = update.message.from_user.id
+        rule_id = await storage.add_rule(user_id, kind, start, end, " ".join(words))
+        day_cache.invalidate_user(user_id)
+
+        until = f" до {format_day(end)}" if end != MAX_DAY else ""
+        await update.message.reply_text(
+            f"✅ Повторяющаяся задача #{rule_id}: {RULE_KINDS[kind]} с {format_day(start)}{until}.\n"
+            f"Остановить: /unrepeat {rule_id}"
+        )
+    except Exception as e:
+        logger.error(f"Error in repeat_task: {e}")
+        await update.message.reply_text("❌ Ошибка при добавлении задачи.")
+
+
+# Команда /unrepeat ID: правило больше не повторяется начиная с сегодня
+async def unrepeat_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        try:
+            rule_id = int(context.args[0])
+        except (IndexError, ValueError):
+            await update.message.reply_text("🔁 Укажите номер правила: /unrepeat 3")
+            return
+
+        user_id = update.message.from_user.id
+        if not await storage.end_rule(rule_id, user_id, today() - 1):
+            await update.message.reply_text("❌ Правило не найдено.")
+            return
+        day_cache.invalidate_user(user_id)
+        await update.message.reply_text(f"✅ Задача #{rule_id} больше не повторяется.")
+    except Exception as e:
+        logger.error(f"Error in unrepeat_task: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
+
+
+# Команды /week [ГГГГ-ММ-ДД] и /month [ГГГГ-ММ]
+async def show_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        day = parse_day(context.args[0]) if context.args else today()
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат даты! Используйте ГГГГ-ММ-ДД")
+        return
+    try:
+        response, reply_markup = await render_range(update.message.from_user.id, 'week', day)
+        await update.message.reply_text(response, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error in show_week: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка при получении задач.")
+
+
+async def show_month(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        day = parse_day(f"{context.args[0]}-01") if context.args else today()
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат месяца! Используйте ГГГГ-ММ")
+        return
+    try:
+        response, reply_markup = await render_range(update.message.from_user.id, 'month', day)
+        await update.message.reply_text(response, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error in show_month: {e}")
         await update.message.reply_text("⚠️ Произошла ошибка при получении задач.")
 
 
+# Склейка нажатий навигации по сообщению.
+# Обработчик сразу отвечает на нажатие и ставит отрисовку в фоновую задачу;
+# следующее нажатие на то же сообщение отменяет еще не начатую отправку,
+# поэтому уходит только последний edit_message_text. Отправки одного
+# сообщения не пересекаются: новая дожидается уже начатой.
+class NavigationCoalescer:
+    def __init__(self, delay: float):
+        self.delay = delay
+        # ключ сообщения -> ожидающая отрисовка / идущая отправка
+        self._pending = {}
+        self._sending = {}
+        self.requested = 0
+        self.rendered = 0
+        self.skipped = 0
+
+    @staticmethod
+    def key(query) -> tuple:
+        if query.message is not None:
+            return query.message.chat_id, query.message.message_id
+        return None, query.inline_message_id
+
+    def _cancel(self, key) -> None:
+        task = self._pending.get(key)
+        if task is not None and not task.done() and self._sending.get(key) is not task:
+            task.cancel()
+            self.skipped += 1
+
+    def _forget(self, key, task) -> None:
+        if self._pending.get(key) is task:
+            del self._pending[key]
+
+    def submit(self, query, prepare, spawn=asyncio.create_task) -> None:
+        # prepare() возвращает (текст, клавиатура)
+        key = self.key(query)
+        self.requested += 1
+        self._cancel(key)
+        task = spawn(self._render(key, query, prepare))
+        self._pending[key] = task
+        task.add_done_callback(functools.partial(self._forget, key))
+
+    async def settle(self, query) -> None:
+        # Перед другим изменением сообщения: ожидающая отрисовка отменяется,
+        # начатая отправка дожидается
+        key = self.key(query)
+        self._cancel(key)
+        sending = self._sending.get(key)
+        if sending is not None:
+            await asyncio.wait([sending])
+
+    async def _render(self, key, query, prepare) -> None:
+        task = asyncio.current_task()
+        try:
+            await asyncio.sleep(self.delay)
+            text, reply_markup = await prepare()
+            sending = self._sending.get(key)
+            if sending is not None:
+                await asyncio.wait([sending])
+            self._sending[key] = task
+            await query.edit_message_text(text, reply_markup=reply_markup)
+            self.rendered += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in navigation render: {e}")
+            try:
+                await query.edit_message_text("⚠️ Произошла ошибка при обработке запроса.")
+            except:
+                pass
+        finally:
+            if self._sending.get(key) is task:
+                del self._sending[key]
+
+    async def join(self) -> None:
+        while self._pending:
+            await asyncio.wait(list(self._pending.values()))
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'requested': self.requested,
+            'rendered': self.rendered,
+            'skipped': self.skipped,
+        }
+
+
+navigation = NavigationCoalescer(NAVIGATION_DELAY)
+
+NAVIGATION_PREFIXES = ("prev_", "next_", "page_", "search_", "week_", "month_", "back_", "day_")
+
+
+# Текст и клавиатура для кнопок навигации
+async def navigation_view(user_id: int, data: str, user_data: dict) -> tuple:
+    # Навигация по дням
+    if data.startswith("prev_") or data.startswith("next_"):
+        day = callback_day(data.split("_")[1])
+
+        response, reply_markup, has_tasks = await render_day(user_id, day)
+
+        if not has_tasks:
+            return f"🤷‍♂️ На {format_day(day)} задач нет!", None
+        return response, reply_markup
+
+    # Листание страниц списка задач
+    if data.startswith("page_"):
+        _, day, page = data.split("_")
+
+        response, reply_markup, has_tasks = await render_day(user_id, callback_day(day), int(page))
+        return response, reply_markup
+
+    # Листание результатов поиска
+    if data.startswith("search_"):
+        words = user_data.get('search')
+        if not words:
+            return "🔎 Поиск устарел, повторите /search", None
+
+        response, reply_markup, has_tasks = await render_search(user_id, words, int(data.split("_")[1]))
+        return response, reply_markup
+
+    # Обзор недели или месяца
+    if data.startswith("week_") or data.startswith("month_"):
+        kind, key = data.split("_")
+        # В старых кнопках месяц записан как ГГГГ-ММ
+        day = callback_day(f"{key}-01" if key.count('-') == 1 else key)
+
+        return await render_range(user_id, kind, day)
+
+    # Возврат к списку задач или переход к дню из обзора
+    day = callback_day(data.split("_")[1])
+
+    response, reply_markup, has_tasks = await render_day(user_id, day)
+    return response, reply_markup
+
+
 # Обработка инлайн-кнопок
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
@@ -221,34 +3038,36 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         data = query.data
         user_id = query.from_user.id
 
+        # Навигация отрисовывается в фоне, см. NavigationCoalescer
+        if data.startswith(NAVIGATION_PREFIXES):
+            spawn = context.application.create_task if context.application is not None else asyncio.create_task
+            navigation.submit(query, functools.partial(navigation_view, user_id, data, context.user_data), spawn)
+            return
+
+        # Остальные кнопки меняют сообщение сами
+        await navigation.settle(query)
+
         # Просмотр задачи
         if data.startswith("view_"):
             task_id = data.split("_")[1]
 
-            conn = sqlite3.connect('planner.db')
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT date, task, completed FROM tasks WHERE id = ? AND user_id = ?",
-                (task_id, user_id)
-            )
-            task = cursor.fetchone()
-            conn.close()
+            task = await storage.get_task(task_id, user_id)
 
             if task:
-                date, task_text, completed = task
+                day, task_text, completed = task
                 status = "✅ Выполнена" if completed else "🟩 В процессе"
 
                 keyboard = [
                     [InlineKeyboardButton("✅ Выполнить", callback_data=f"done_{task_id}")],
                     [InlineKeyboardButton("✏️ Редактировать", callback_data=f"edit_{task_id}")],
                     [InlineKeyboardButton("❌ Удалить", callback_data=f"delete_{task_id}")],
-                    [InlineKeyboardButton("🔙 Назад к задачам", callback_data=f"back_{date}")]
+                    [InlineKeyboardButton("🔙 Назад к задачам", callback_data=f"back_{day}")]
                 ]
 
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await query.edit_message_text(
                     text=f"📝 Задача #{task_id}\n\n"
-                         f"🗓 Дата: {date}\n"
+                         f"🗓 Дата: {format_day(day)}\n"
                          f"📌 Описание: {task_text}\n"
                          f"🔰 Статус: {status}",
                     reply_markup=reply_markup
@@ -258,14 +3077,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         elif data.startswith("done_"):
             task_id = data.split("_")[1]
 
-            conn = sqlite3.connect('planner.db')
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE tasks SET completed = 1 WHERE id = ? AND user_id = ?",
-                (task_id, user_id)
-            )
-            conn.commit()
-            conn.close()
+            day = await storage.complete_task(task_id, user_id)
+            if day is None:
+                await query.edit_message_text("❌ Задача не найдена.")
+                return
+            day_cache.invalidate((user_id, day))
 
             await query.edit_message_text(f"✅ Задача #{task_id} отмечена выполненной!")
 
@@ -280,90 +3096,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         elif data.startswith("delete_"):
             task_id = data.split("_")[1]
 
-            conn = sqlite3.connect('planner.db')
-            cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM tasks WHERE id = ? AND user_id = ?",
-                (task_id, user_id)
-            )
-            conn.commit()
-            conn.close()
-
-            await query.edit_message_text(f"❌ Задача #{task_id} удалена!")
-
-        # Навигация по дням
-        elif data.startswith("prev_") or data.startswith("next_"):
-            new_date = data.split("_")[1]
-
-            conn = sqlite3.connect('planner.db')
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, task, completed FROM tasks WHERE user_id = ? AND date = ?",
-                (user_id, new_date)
-            )
-            tasks = cursor.fetchall()
-            conn.close()
-
-            if not tasks:
-                await query.edit_message_text(f"🤷‍♂️ На {new_date} задач нет!")
+            day = await storage.delete_task(task_id, user_id)
+            if day is None:
+                await query.edit_message_text("❌ Задача не найдена.")
                 return
+            day_cache.invalidate((user_id, day))
 
-            keyboard = []
-            response = f"📝 Задачи на {new_date}:\n\n"
-
-            for task_id, task_text, completed in tasks:
-                status = "✅" if completed else "🟩"
-                response += f"{task_id}. [{status}] {task_text}\n"
-
-                keyboard.append([
-                    InlineKeyboardButton(f"{task_id}. {task_text[:15]}...", callback_data=f"view_{task_id}")
-                ])
-
-            prev_date = (datetime.strptime(new_date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-            next_date = (datetime.strptime(new_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-
-            keyboard.append([
-                InlineKeyboardButton("◀️ Пред. день", callback_data=f"prev_{prev_date}"),
-                InlineKeyboardButton("▶️ След. день", callback_data=f"next_{next_date}")
-            ])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(response, reply_markup=reply_markup)
-
-        # Возврат к списку задач
-        elif data.startswith("back_"):
-            date = data.split("_")[1]
-
-            conn = sqlite3.connect('planner.db')
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, task, completed FROM tasks WHERE user_id = ? AND date = ?",
-                (user_id, date)
-            )
-            tasks = cursor.fetchall()
-            conn.close()
-
-            keyboard = []
-            response = f"📝 Задачи на {date}:\n\n"
-
-            for task_id, task_text, completed in tasks:
-                status = "✅" if completed else "🟩"
-                response += f"{task_id}. [{status}] {task_text}\n"
-
-                keyboard.append([
-                    InlineKeyboardButton(f"{task_id}. {task_text[:15]}...", callback_data=f"view_{task_id}")
-                ])
-
-            prev_date = (datetime.strptime(date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-            next_date = (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-
-            keyboard.append([
-                InlineKeyboardButton("◀️ Пред. день", callback_data=f"prev_{prev_date}"),
-                InlineKeyboardButton("▶️ След. день", callback_data=f"next_{next_date}")
-            ])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(response, reply_markup=reply_markup)
+            await query.edit_message_text(f"❌ Задача #{task_id} удалена!")
     except Exception as e:
         logger.error(f"Error in button_handler: {e}")
         try:
@@ -382,9 +3121,15 @@ async def edit_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
 
+# ID из сообщения: номер задачи или id повторения вида r3.739314
+def parse_task_id(text: str):
+    text = text.strip()
+    return text if parse_occurrence(text) is not None else int(text)
+
+
 async def get_edit_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
-        task_id = int(update.message.text)
+        task_id = parse_task_id(update.message.text)
         context.user_data['edit_id'] = task_id
         await update.message.reply_text("📝 Введите новый текст задачи:")
         return NEW_TEXT
@@ -402,29 +3147,20 @@ async def get_new_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         task_id = context.user_data['edit_id']
         user_id = update.message.from_user.id
 
-        conn = sqlite3.connect('planner.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE tasks SET task = ? WHERE id = ? AND user_id = ?",
-            (new_text, task_id, user_id)
-        )
-        conn.commit()
-
         # Получаем дату для возврата
-        cursor.execute(
-            "SELECT date FROM tasks WHERE id = ?",
-            (task_id,)
-        )
-        task_date = cursor.fetchone()[0]
-        conn.close()
+        task_day = await storage.update_task_text(task_id, user_id, new_text)
+        if task_day is None:
+            await update.message.reply_text("❌ Задача не найдена.")
+            return ConversationHandler.END
+        day_cache.invalidate((user_id, task_day))
 
         await update.message.reply_text("✅ Задача обновлена!")
 
         # Показываем обновленный список
         await context.bot.send_message(
             chat_id=user_id,
-            text=f"📝 Задачи на {task_date}:",
-            reply_markup=get_tasks_keyboard(user_id, task_date)
+            text=f"📝 Задачи на {format_day(task_day)}:",
+            reply_markup=await get_tasks_keyboard(user_id, task_day)
         )
 
         return ConversationHandler.END
@@ -446,33 +3182,22 @@ async def delete_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
-        task_id = int(update.message.text)
+        task_id = parse_task_id(update.message.text)
         user_id = update.message.from_user.id
 
-        conn = sqlite3.connect('planner.db')
-        cursor = conn.cursor()
-
         # Получаем дату перед удалением
-        cursor.execute(
-            "SELECT date FROM tasks WHERE id = ?",
-            (task_id,)
-        )
-        task_date = cursor.fetchone()[0]
-
-        cursor.execute(
-            "DELETE FROM tasks WHERE id = ? AND user_id = ?",
-            (task_id, user_id)
-        )
-        conn.commit()
-        conn.close()
+        task_day = await storage.delete_task(task_id, user_id)
+        if task_day is None:
+            raise ValueError(f"Task {task_id} not found")
+        day_cache.invalidate((user_id, task_day))
 
         await update.message.reply_text(f"✅ Задача {task_id} удалена!")
 
         # Показываем обновленный список
         await context.bot.send_message(
             chat_id=user_id,
-            text=f"📝 Задачи на {task_date}:",
-            reply_markup=get_tasks_keyboard(user_id, task_date)
+            text=f"📝 Задачи на {format_day(task_day)}:",
+            reply_markup=await get_tasks_keyboard(user_id, task_day)
         )
 
         return ConversationHandler.END
@@ -486,32 +3211,10 @@ async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 # Генератор клавиатуры для задач
-def get_tasks_keyboard(user_id: int, date: str) -> InlineKeyboardMarkup:
+async def get_tasks_keyboard(user_id: int, day: int) -> InlineKeyboardMarkup:
     try:
-        conn = sqlite3.connect('planner.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, task, completed FROM tasks WHERE user_id = ? AND date = ?",
-            (user_id, date)
-        )
-        tasks = cursor.fetchall()
-        conn.close()
-
-        keyboard = []
-        for task_id, task_text, completed in tasks:
-            keyboard.append([
-                InlineKeyboardButton(f"{task_id}. {task_text[:15]}...", callback_data=f"view_{task_id}")
-            ])
-
-        prev_date = (datetime.strptime(date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-        next_date = (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-
-        keyboard.append([
-            InlineKeyboardButton("◀️ Пред. день", callback_data=f"prev_{prev_date}"),
-            InlineKeyboardButton("▶️ След. день", callback_data=f"next_{next_date}")
-        ])
-
-        return InlineKeyboardMarkup(keyboard)
+        response, reply_markup, has_tasks = await render_day(user_id, day)
+        return reply_markup
     except Exception as e:
         logger.error(f"Error in get_tasks_keyboard: {e}")
         return InlineKeyboardMarkup([])
@@ -527,23 +3230,188 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
 
+# Мгновенные показатели внутренних очередей и кэшей
+def runtime_gauges() -> dict:
+    gauges = {f"day_cache_{name}": value for name, value in day_cache.stats().items()}
+    gauges.update({f"write_{name}": value for name, value in storage.stats().items()})
+    gauges.update({f"outbound_{name}": value for name, value in outbound.stats().items()})
+    gauges.update({f"navigation_{name}": value for name, value in navigation.stats().items()})
+    gauges['reminder_subscribers'] = len(reminder_wheel)
+    return gauges
+
+
+metrics.add_gauges(runtime_gauges)
+
+
+# HTTP-эндпоинт /metrics в текстовом формате Prometheus
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b'/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b''
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+
+# Периодический вывод метрик в лог
+async def dump_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info(f"Metrics:\n{metrics.render()}")
+
+
+metrics_server = None
+
+
+# Загрузка подписок при запуске бота
+async def on_startup(application) -> None:
+    global metrics_server
+    started = clock.monotonic()
+    reminder_wheel.load(await storage.load_subscriptions())
+    logger.info(f"Loaded {len(reminder_wheel)} reminder subscriptions in {clock.monotonic() - started:.2f}s")
+
+    if METRICS_PORT:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+        logger.info(f"Metrics are served on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+
+# Параллельная обработка обновлений с сохранением порядка для каждого
+# пользователя: обновления разных пользователей идут одновременно, а обновления
+# одного пользователя (шаги диалога, нажатия кнопок) - строго по очереди.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Семафор базового класса берется в process_update до do_process_update, то есть
+    # до блокировки пользователя: очередь одного пользователя заняла бы все места.
+    # Поэтому базовому классу передается заведомо большой предел, а настоящий
+    # предел - свой семафор, который берется уже под блокировкой пользователя.
+    UNBOUNDED = 2 ** 30
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(self.UNBOUNDED)
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # ключ -> [блокировка, число ожидающих обновлений]
+        self._locks = {}
+
+    @staticmethod
+    def _key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock отдает блокировку в порядке ожидания
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# Закрытие хранилища при остановке бота
+async def on_shutdown(application) -> None:
+    if metrics_server is not None:
+        metrics_server.close()
+    await storage.close()
+
+
 def main() -> None:
     try:
         logger.info("Starting bot...")
+        if not BOT_TOKEN:
+            raise ValueError("PLANNER_TOKEN is required")
         # Создаем приложение с помощью ApplicationBuilder
-        application = ApplicationBuilder() \
-            .token("7969788951:AAHBlSslGj2vecmP8n7Apz-bC8nNmyfgZQU") \
-            .build()
+        builder = ApplicationBuilder() \
+            .token(BOT_TOKEN) \
+            .post_init(on_startup) \
+            .post_shutdown(on_shutdown) \
+            .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES)) \
+            .rate_limiter(outbound)
+        if METRICS_ENABLED:
+            builder = builder.request(TimedRequest(connection_pool_size=256))
+        if API_BASE_URL:
+            base_url = API_BASE_URL.rstrip('/')
+            builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+        if STATE_DB_PATH:
+            builder = builder.persistence(SQLitePersistence(STATE_DB_PATH))
+        application = builder.build()
+
+        # Единая задача рассылки напоминаний, срабатывает в начале каждой минуты
+        if application.job_queue is not None:
+            application.job_queue.run_repeating(
+                send_daily_reminder,
+                interval=60,
+                first=60 - datetime.now().second,
+                name='daily_reminders'
+            )
+        else:
+            logger.warning("Job queue is not available - reminders disabled")
+
+        if ARCHIVE_AFTER_DAYS and application.job_queue is not None:
+            application.job_queue.run_repeating(archive_tasks, interval=ARCHIVE_INTERVAL, first=60, name='archive')
+
+        if METRICS_DUMP_INTERVAL and application.job_queue is not None:
+            application.job_queue.run_repeating(dump_metrics, interval=METRICS_DUMP_INTERVAL, name='metrics_dump')
 
         # Обработчики команд
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("list", list_tasks))
-
-        # Обработчик инлайн-кнопок
-        application.add_handler(CallbackQueryHandler(button_handler))
+        application.add_handler(CommandHandler("timezone", set_timezone))
+        application.add_handler(CommandHandler("remind", set_reminder_time))
+        application.add_handler(CommandHandler("export", export_tasks))
+        application.add_handler(CommandHandler("week", show_week))
+        application.add_handler(CommandHandler("month", show_month))
+        application.add_handler(CommandHandler("search", search_tasks))
+        application.add_handler(CommandHandler("repeat", repeat_task))
+        application.add_handler(CommandHandler("unrepeat", unrepeat_task))
+
+        # Импорт задач из файлов
+        application.add_handler(MessageHandler(
+            filters.Document.FileExtension("csv") | filters.Document.FileExtension("ics"),
+            import_document
+        ))
+
+        # Обработчик инлайн-кнопок; edit_ начинает диалог редактирования ниже
+        application.add_handler(CallbackQueryHandler(button_handler, pattern='^(?!edit_)'))
 
         # Диалог добавления задачи
         add_conv_handler = ConversationHandler(
+            name='add_task',
+            persistent=bool(STATE_DB_PATH),
             entry_points=[CommandHandler('add', add_task)],
             states={
                 DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_date)],
@@ -553,19 +3421,30 @@ def main() -> None:
         )
         application.add_handler(add_conv_handler)
 
-        # Диалог редактирования
+        # Диалог редактирования. Кнопка edit_ только открывает диалог, дальше он идет
+        # сообщениями, поэтому per_message=False здесь намеренный и предупреждение PTB лишнее
+        warnings.filterwarnings('ignore', message="If 'per_message=False'", category=PTBUserWarning)
         edit_conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('edit', edit_task)],
+            name='edit_task',
+            persistent=bool(STATE_DB_PATH),
+            entry_points=[
+                CommandHandler('edit', edit_task),
+                CallbackQueryHandler(button_handler, pattern='^edit_')
+            ],
             states={
                 EDIT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_edit_id)],
                 NEW_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_new_text)]
             },
-            fallbacks=[CommandHandler('cancel', cancel)]
+            fallbacks=[CommandHandler('cancel', cancel)],
+            # Кнопка "Изменить" другой задачи начинает диалог заново
+            allow_reentry=True
         )
         application.add_handler(edit_conv_handler)
 
         # Диалог удаления
         del_conv_handler = ConversationHandler(
+            name='delete_task',
+            persistent=bool(STATE_DB_PATH),
             entry_points=[CommandHandler('delete', delete_task)],
             states={
                 DELETE: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_delete)]
@@ -574,9 +3453,32 @@ def main() -> None:
         )
         application.add_handler(del_conv_handler)
 
+        if METRICS_ENABLED:
+            instrument_handlers(application)
+
         # Запуск бота
-        logger.info("Bot is running...")
-        application.run_polling()
+        if BOT_MODE == 'webhook':
+            if not WEBHOOK_URL:
+                raise ValueError("PLANNER_WEBHOOK_URL is required in webhook mode")
+            secret_token = WEBHOOK_SECRET
+            if not secret_token:
+                # Вебхук регистрируется заново при каждом запуске, поэтому
+                # случайный секрет достаточен, если он не задан явно
+                secret_token = secrets.token_urlsafe(32)
+                logger.warning("PLANNER_WEBHOOK_SECRET is not set - using a random secret token")
+
+            logger.info(f"Bot is running (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT})...")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=secret_token,
+                max_connections=min(CONCURRENT_UPDATES, 100)
+            )
+        else:
+            logger.info("Bot is running...")
+            application.run_polling()
     except Exception as e:
         logger.critical(f"Critical error in main: {e}")
 